@@ -0,0 +1,219 @@
+import collections
+
+import numpy as np
+
+from displaylist import PRIM_LINE, PRIM_DOT, colormul
+
+RENDER_GRAYSCALE = 1
+RENDER_NOREORDER = 2
+RENDER_CULLDARK = 4
+
+PRIM_DTYPE = np.dtype([
+    ("type", np.uint8),
+    ("p0", np.float32, 2),
+    ("p1", np.float32, 2),
+    ("color", np.uint32),
+    ("samples", np.uint16),
+])
+
+class RenderParams(object):
+    def __init__(self):
+        self.rate = 48000
+        self.on_speed = 2/100.0
+        self.off_speed = 2/20.0
+        self.start_wait = 8
+        self.start_dwell = 3
+        self.curve_dwell = 0
+        self.corner_dwell = 6
+        self.end_dwell = 3
+        self.end_wait = 7
+        self.curve_angle = 0
+        self.flatness = 0.00001
+        self.snap = 0.00001
+        self.render_flags = RENDER_GRAYSCALE
+        self.min_length = 0
+        self.max_framelen = 0
+
+# Implements the subset of the pylase API that the renderer uses, without
+# talking to any hardware. This base class only counts calls; subclasses hook
+# the primitive calls.
+class NullBackend(object):
+    RENDER_GRAYSCALE = RENDER_GRAYSCALE
+    RENDER_NOREORDER = RENDER_NOREORDER
+    RENDER_CULLDARK = RENDER_CULLDARK
+    RenderParams = RenderParams
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.params = None
+        self.num_outputs = 1
+        self.output = 0
+        self.frames = 0
+
+    def init(self, buffer_count=2, max_points=30000, num_outputs=1):
+        self.calls["init"] += 1
+        self.num_outputs = num_outputs
+        self.output = 0
+
+    def shutdown(self):
+        self.calls["shutdown"] += 1
+
+    def setRenderParams(self, params):
+        self.calls["setRenderParams"] += 1
+        self.params = params
+
+    def setScissor(self, p0, p1):
+        self.calls["setScissor"] += 1
+
+    def setOutput(self, output):
+        self.calls["setOutput"] += 1
+        self.output = output
+
+    def loadIdentity(self):
+        self.calls["loadIdentity"] += 1
+
+    def pushMatrix(self):
+        self.calls["pushMatrix"] += 1
+
+    def popMatrix(self):
+        self.calls["popMatrix"] += 1
+
+    def scale(self, s):
+        self.calls["scale"] += 1
+
+    def translate(self, d):
+        self.calls["translate"] += 1
+
+    def resetColor(self):
+        self.calls["resetColor"] += 1
+
+    def pushColor(self):
+        self.calls["pushColor"] += 1
+
+    def popColor(self):
+        self.calls["popColor"] += 1
+
+    def multColor(self, color):
+        self.calls["multColor"] += 1
+
+    def line(self, p1, p2, color):
+        self.calls["line"] += 1
+
+    def dot(self, p, samples, color):
+        self.calls["dot"] += 1
+
+    def renderFrame(self, max_fps=0):
+        self.calls["renderFrame"] += 1
+        self.frames += 1
+        return 0.0
+
+# Records every primitive, transformed and color-resolved the same way libol
+# would, into one structured NumPy array per output per frame.
+class RecordingBackend(NullBackend):
+    def __init__(self, keep=1):
+        super().__init__()
+        self.keep = keep
+        self.history = collections.deque(maxlen=keep)
+        self.frame = []
+        self.reset_state()
+
+    def reset_state(self):
+        self.pending = [[] for i in range(self.num_outputs)]
+        self.matrix = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0)
+        self.matrix_stack = []
+        self.color = 0xffffff
+        self.color_stack = []
+
+    def init(self, buffer_count=2, max_points=30000, num_outputs=1):
+        super().init(buffer_count, max_points, num_outputs)
+        self.reset_state()
+
+    def loadIdentity(self):
+        super().loadIdentity()
+        self.matrix = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0)
+
+    def pushMatrix(self):
+        super().pushMatrix()
+        self.matrix_stack.append(self.matrix)
+
+    def popMatrix(self):
+        super().popMatrix()
+        self.matrix = self.matrix_stack.pop()
+
+    def scale(self, s):
+        super().scale(s)
+        a, b, c, d, e, f = self.matrix
+        sx, sy = s
+        self.matrix = (a * sx, b * sy, c, d * sx, e * sy, f)
+
+    def translate(self, t):
+        super().translate(t)
+        a, b, c, d, e, f = self.matrix
+        tx, ty = t
+        self.matrix = (a, b, a * tx + b * ty + c, d, e, d * tx + e * ty + f)
+
+    def resetColor(self):
+        super().resetColor()
+        self.color = 0xffffff
+
+    def pushColor(self):
+        super().pushColor()
+        self.color_stack.append(self.color)
+
+    def popColor(self):
+        super().popColor()
+        self.color = self.color_stack.pop()
+
+    def multColor(self, color):
+        super().multColor(color)
+        self.color = colormul(self.color, color)
+
+    def transform(self, p):
+        a, b, c, d, e, f = self.matrix
+        x, y = p
+        return (a * x + b * y + c, d * x + e * y + f)
+
+    def line(self, p1, p2, color):
+        super().line(p1, p2, color)
+        self.pending[self.output].append((PRIM_LINE, self.transform(p1),
+            self.transform(p2), colormul(self.color, color), 0))
+
+    def dot(self, p, samples, color):
+        super().dot(p, samples, color)
+        p = self.transform(p)
+        self.pending[self.output].append((PRIM_DOT, p, p,
+            colormul(self.color, color), samples))
+
+    def renderFrame(self, max_fps=0):
+        super().renderFrame(max_fps)
+        self.frame = [np.array(prims, dtype=PRIM_DTYPE) for prims in self.pending]
+        self.history.append(self.frame)
+        self.pending = [[] for i in range(self.num_outputs)]
+        return 0.0
+
+    def frame_stats(self, frame=None):
+        if frame is None:
+            frame = self.frame
+        stats = []
+        for prims in frame:
+            lines = prims[prims["type"] == PRIM_LINE]
+            dots = prims[prims["type"] == PRIM_DOT]
+            length = np.hypot(*(lines["p1"] - lines["p0"]).T).sum()
+            stats.append({
+                "lines": len(lines),
+                "dots": len(dots),
+                "dot_samples": int(dots["samples"].sum()),
+                "line_length": float(length),
+            })
+        return stats
+
+BACKENDS = {
+    "null": NullBackend,
+    "record": RecordingBackend,
+}
+
+def get_backend(name="pylase"):
+    if name == "pylase":
+        import pylase
+        return pylase
+    return BACKENDS[name]()
@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+# Audio beat tracking: streaming spectral-flux onset detection plus a tempo /
+# phase tracker that taps BPMThread.kick() on detected beats.
+import sys, threading, argparse, wave
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from bpm import mono
+
+AUDIO_RATE = 44100
+
+def pcm_to_float(data, width, channels):
+    if width == 1:
+        x = (np.frombuffer(data, np.uint8).astype(np.float32) - 128) / 128
+    elif width == 2:
+        x = np.frombuffer(data, "<i2").astype(np.float32) / 32768
+    elif width == 4:
+        x = np.frombuffer(data, "<i4").astype(np.float32) / 2147483648
+    else:
+        raise ValueError("unsupported sample width %d" % width)
+    if channels > 1:
+        x = x[:len(x) - len(x) % channels].reshape(-1, channels).mean(1)
+    return x
+
+# Yields (rate, block) from a WAV file as mono float32
+def read_wav(path, block=1024):
+    with wave.open(path, "rb") as w:
+        rate, width, channels = w.getframerate(), w.getsampwidth(), w.getnchannels()
+        while True:
+            data = w.readframes(block)
+            if not data:
+                return
+            yield rate, pcm_to_float(data, width, channels)
+
+# Yields mono float32 blocks of raw little-endian PCM from a binary stream
+def read_raw(fd, channels=1, width=2, block=1024):
+    size = block * channels * width
+    while True:
+        data = fd.read(size)
+        if not data:
+            return
+        yield pcm_to_float(data, width, channels)
+
+# Spectral flux on log-compressed magnitude spectra. Every complete frame in
+# a block is transformed in one batched FFT; peaks are picked with a local
+# maximum over [i - pre, i + post] frames and a moving-mean threshold, so an
+# onset is reported post frames (plus half a window) after it happens.
+class OnsetDetector(object):
+    def __init__(self, rate=AUDIO_RATE, n=1024, hop=256, band=(0, 16000),
+                 pre=3, post=2, avg=16, ratio=2.0, delta=1.0, min_gap=0.05, compress=100):
+        self.rate = rate
+        self.n = n
+        self.hop = hop
+        self.pre = pre
+        self.post = post
+        self.avg = avg
+        self.ratio = ratio
+        self.delta = delta
+        self.min_gap = int(min_gap * rate / hop)
+        self.compress = compress
+        freqs = np.fft.rfftfreq(n, 1.0 / rate)
+        self.bins = slice(np.searchsorted(freqs, band[0]), np.searchsorted(freqs, band[1]))
+        self.window = np.hanning(n).astype(np.float32)
+        self.reset()
+
+    def reset(self):
+        self.buf = np.zeros(0, np.float32)
+        self.pos = 0            # sample index of buf[0]
+        self.frame = 0          # index of the next frame to compute
+        self.prev = None
+        self.hist = np.zeros(0)
+        self.hpos = 0           # frame index of hist[0]
+        self.checked = 0        # next frame to peak-pick
+        self.last = -self.min_gap
+
+    # Sample index at the centre of frame i
+    def frame_sample(self, i):
+        return i * self.hop + self.n / 2
+
+    # Feeds samples; returns the new flux values and a list of onsets as
+    # (sample index, strength)
+    def process(self, x):
+        buf = np.concatenate((self.buf, x))
+        nframes = (len(buf) - self.n) // self.hop + 1 if len(buf) >= self.n else 0
+        flux = np.zeros(0)
+        if nframes:
+            frames = sliding_window_view(buf, self.n)[::self.hop][:nframes]
+            spec = np.log1p(self.compress * np.abs(np.fft.rfft(frames * self.window, axis=1)[:, self.bins]))
+            prev = spec[:1] if self.prev is None else self.prev[None]
+            flux = np.maximum(np.diff(np.concatenate((prev, spec)), axis=0), 0).mean(1)
+            self.prev = spec[-1]
+            self.frame += nframes
+            drop = nframes * self.hop
+            self.pos += drop
+            buf = buf[drop:]
+        self.buf = buf
+        return flux, self.pick(flux)
+
+    def pick(self, flux):
+        hist = np.concatenate((self.hist, flux))
+        end = self.hpos + len(hist) - self.post        # frames with full lookahead
+        start = max(self.checked, self.hpos + self.pre)
+        onsets = []
+        if end > start:
+            lo, hi = start - self.hpos, end - self.hpos
+            win = sliding_window_view(hist, self.pre + self.post + 1)[lo - self.pre:hi - self.pre]
+            # Threshold window [i - avg, i + post]; zeros before the first frame
+            padded = np.concatenate((np.zeros(self.avg), hist))
+            mean = sliding_window_view(padded, self.avg + self.post + 1)[lo:hi].mean(1)
+            c = win[:, self.pre]
+            hit = np.flatnonzero((c == win.max(1)) & (c >= self.ratio * mean + self.delta))
+            for k in hit.tolist():
+                i = start + k
+                if i - self.last < self.min_gap:
+                    continue
+                self.last = i
+                # Parabolic interpolation of the peak position
+                a, b, d = win[k, self.pre - 1], win[k, self.pre], win[k, self.pre + 1]
+                den = a - 2 * b + d
+                off = 0.5 * (a - d) / den if den else 0.0
+                onsets.append((self.frame_sample(i + off), float(b)))
+            self.checked = end
+        keep = self.pre + self.avg + self.post
+        if len(hist) > keep:
+            self.hpos += len(hist) - keep
+            hist = hist[-keep:]
+        self.hist = hist
+        return onsets
+
+# Turns onsets into beats. The tempo comes from the autocorrelation of the
+# onset envelope over the last few seconds (log-Gaussian prior around
+# 120 BPM); onsets close to the predicted beat grid are forwarded to
+# target.kick(t). When the grid is lost it re-locks on an onset that lines up
+# with the envelope better than the half-period offset, and calls
+# target.reset(t) first so the BPM thread re-derives the period from the
+# next kick.
+class BeatTracker(object):
+    def __init__(self, target, rate=AUDIO_RATE, seconds=6.0, tempo_every=0.5,
+                 bpm_range=(70, 190), bpm_prior=120, tolerance=0.15, band=(20, 250), **kw):
+        self.target = target
+        self.rate = rate
+        self.onsets = OnsetDetector(rate, band=band, **kw)
+        self.fps = rate / self.onsets.hop
+        self.size = int(seconds * self.fps)
+        self.env = np.zeros(self.size)
+        self.tempo_every = int(tempo_every * self.fps)
+        self.lags = np.arange(int(self.fps * 60 / bpm_range[1]), int(self.fps * 60 / bpm_range[0]) + 1)
+        self.prior = np.exp(-0.5 * (np.log2(60 * self.fps / self.lags / bpm_prior) / 0.9) ** 2)
+        self.tolerance = tolerance
+        self.frames = 0
+        self.samples = 0
+        self.lag = None
+        self.last_beat = None
+        self.now = None
+
+    @property
+    def period(self):
+        return self.lag / self.fps if self.lag else None
+
+    def estimate_tempo(self):
+        n = min(self.frames, self.size)
+        if n < self.lags[-1] * 3:
+            return
+        e = self.env[-n:] - self.env[-n:].mean()
+        f = np.fft.rfft(e, 1 << (2 * n - 1).bit_length())
+        # Unbiased autocorrelation, summed over the first few multiples of
+        # each lag so off-beat and backbeat periodicities do not win
+        ac = np.fft.irfft(f * f.conj())[:n] / (n - np.arange(n))
+        if ac[0] <= 0:
+            return
+        ac = np.concatenate((ac, np.zeros(4 * self.lags[-1])))
+        score = (ac[self.lags] + 0.5 * ac[2 * self.lags] + 0.25 * ac[4 * self.lags]) * self.prior
+        k = int(np.argmax(score))
+        lag = float(self.lags[k])
+        if 0 < k < len(score) - 1:
+            a, b, c = score[k - 1], score[k], score[k + 1]
+            den = a - 2 * b + c
+            if den:
+                lag += 0.5 * (a - c) / den
+        self.lag = lag
+
+    def comb(self, frame):
+        # Envelope energy on a beat grid through frame vs. half a beat off it
+        i = np.round(frame - self.frames + self.size - self.lag * np.arange(4)).astype(int)
+        h = np.round(i - self.lag / 2).astype(int)
+        ok = (i >= 0) & (i < self.size) & (h >= 0)
+        return self.env[i[ok]].sum(), self.env[h[ok]].sum()
+
+    # Feeds a block of mono samples; t is the time of its first sample
+    def feed(self, x, t):
+        base = t - self.samples / self.rate
+        self.samples += len(x)
+        self.now = base + self.samples / self.rate
+        flux, onsets = self.onsets.process(x)
+        n = len(flux)
+        if n:
+            if n >= self.size:
+                self.env[:] = flux[-self.size:]
+            else:
+                self.env[:-n] = self.env[n:]
+                self.env[-n:] = flux
+            before = self.frames
+            self.frames += n
+            if self.frames // self.tempo_every != before // self.tempo_every:
+                self.estimate_tempo()
+        for pos, strength in onsets:
+            self.onset(base + pos / self.rate, pos)
+
+    def onset(self, t, pos):
+        period = self.period
+        if period is None:
+            return
+        if self.last_beat is not None and t - self.last_beat > 4 * period:
+            self.last_beat = None
+        if self.last_beat is None:
+            on, off = self.comb((pos - self.onsets.n / 2) / self.onsets.hop)
+            if on < off:
+                return
+            self.target.reset(t)
+            self.last_beat = t
+            return
+        dt = t - self.last_beat
+        beats = round(dt / period)
+        if beats >= 1 and abs(dt - beats * period) <= self.tolerance * period:
+            self.last_beat = t
+            self.target.kick(t)
+
+# Live input: reads raw PCM from a stream (e.g. an arecord pipe) and feeds
+# the tracker. Block times come from the minimum observed arrival latency, so
+# timestamps follow the sample clock instead of read() jitter.
+class BeatThread(threading.Thread):
+    def __init__(self, target, fd, rate=AUDIO_RATE, channels=1, block=512):
+        threading.Thread.__init__(self, daemon=True)
+        self.fd = fd
+        self.channels = channels
+        self.block = block
+        self.tracker = BeatTracker(target, rate)
+        self.active = True
+
+    def run(self):
+        rate = self.tracker.rate
+        base = None
+        samples = 0
+        for x in read_raw(self.fd, self.channels, block=self.block):
+            if not self.active:
+                break
+            est = mono() - (samples + len(x)) / rate
+            if base is None or est < base:
+                base = est
+            else:
+                base += 0.001 * (est - base)
+            self.tracker.feed(x, base + samples / rate)
+            samples += len(x)
+
+class PrintTarget(object):
+    def __init__(self, tracker=None):
+        self.tracker = tracker
+
+    def reset(self, t):
+        print("lock  %9.3f" % t)
+
+    def kick(self, t):
+        period = self.tracker.period if self.tracker else None
+        print("beat  %9.3f  %6.1f BPM" % (t, 60 / period if period else 0))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Print beats detected in audio")
+    parser.add_argument("input", help="WAV file, or - for raw s16le PCM on stdin")
+    parser.add_argument("--rate", type=int, default=AUDIO_RATE)
+    parser.add_argument("--channels", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    target = PrintTarget()
+    if args.input == "-":
+        tracker = BeatTracker(target, args.rate)
+        blocks = read_raw(sys.stdin.buffer, args.channels)
+    else:
+        with wave.open(args.input, "rb") as w:
+            tracker = BeatTracker(target, w.getframerate())
+        blocks = (x for rate, x in read_wav(args.input))
+    target.tracker = tracker
+    t = 0.0
+    for x in blocks:
+        tracker.feed(x, t)
+        t += len(x) / tracker.rate
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
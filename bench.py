@@ -0,0 +1,328 @@
+#!/usr/bin/python3
+# Headless render benchmark. Drives the Renderer and synths with a recording or
+# null pylase backend, so it runs without the native library or a DAC.
+import sys, time, math, random, argparse, threading
+
+import numpy as np
+
+from voices import BasicSynth, VOICES
+from voicepool import PooledSynth
+from util import ADSR, gamma, set_clock, OfflineClock
+from colors import PALETTE
+from laser import Renderer
+from backend import get_backend
+from optimize import REORDER_STRATEGIES
+from bpm import BPMThread, mono
+from dispatch import TickDispatcher
+from beat import BeatTracker, read_wav
+
+SYNTHS = {
+    "object": BasicSynth,
+    "pool": PooledSynth,
+}
+
+class BenchChannel(object):
+    def __init__(self, chid, synth, voice, mode, mult):
+        self.chid = chid
+        self.state = {
+            "fader": 127,
+            "map": mode,
+            "voice": {
+                "type": voice,
+                "env": {"a": 10, "d": 30, "s": 100, "r": 40},
+                "mult": mult,
+            },
+            "color": 1 + chid % (len(PALETTE) - 1),
+        }
+        self.synth = SYNTHS[synth](self, VOICES[voice], ADSR(self.state["voice"]["env"]))
+        self.synth.color = gamma(PALETTE[self.state["color"]])
+
+class BenchScene(object):
+    def __init__(self, channels):
+        self.channels = channels
+
+class BenchParent(object):
+    def __init__(self, scene):
+        self.cur_scene = scene
+
+def bench_render(args, voice):
+    backend = get_backend(args.backend)
+    scene = BenchScene([BenchChannel(i, args.synth, voice, args.mode, args.mult)
+                        for i in range(args.channels)])
+    renderer = Renderer(BenchParent(scene), backend)
+    renderer.budget = args.budget
+    renderer.merge = args.merge
+    renderer.reorder = args.reorder
+    renderer.setup()
+    rng = random.Random(args.seed)
+    if not args.realtime:
+        set_clock(OfflineClock(args.fps))
+
+    prims = 0
+    build = 0
+    t0 = time.perf_counter()
+    for frame in range(args.frames):
+        if frame % args.retrigger == 0:
+            for ch in scene.channels:
+                for i in range(args.width):
+                    if rng.random() < 0.5:
+                        ch.synth.noteon(i / args.width, (i + 1) / args.width, 127,
+                                        args.retrigger / args.fps)
+        t1 = time.perf_counter()
+        renderer.render_frame()
+        build += time.perf_counter() - t1
+        prims += sum(len(p) for p in renderer.frame)
+    total = time.perf_counter() - t0
+
+    print("%-10s %6d frames  %8.3f ms/frame  %8.1f prims/frame" % (
+          voice, args.frames, 1000 * build / args.frames, prims / args.frames))
+    if args.reorder != "none":
+        extra = renderer.stats.summary()["extra"]
+        saved, cost = extra["reorder saved travel"], extra["reorder time"]
+        print("  reorder %s: saved travel mean %.2f, cost mean %.3f ms p99 %.3f ms" % (
+              args.reorder, saved["mean"], cost["mean"] * 1000, cost["p99"] * 1000))
+    if args.backend == "record":
+        for output, st in enumerate(backend.frame_stats()):
+            print("  out %d: %d lines %d dots (%d samples), length %.3f" % (
+                  output, st["lines"], st["dots"], st["dot_samples"], st["line_length"]))
+    else:
+        print("  calls: " + ", ".join("%s=%d" % i for i in sorted(backend.calls.items())))
+    if args.stats:
+        print(renderer.stats.format())
+
+def bench_adsr(args):
+    rng = random.Random(args.seed)
+    env = ADSR({"a": 20, "d": 40, "s": 90, "r": 60})
+    n = args.width * args.channels
+    t = np.array([rng.uniform(0, 3) for i in range(n)])
+    kt = np.array([rng.choice([math.nan, rng.uniform(0, 2)]) for i in range(n)])
+    tl, ktl = t.tolist(), [None if math.isnan(k) else k for k in kt.tolist()]
+
+    def scalar():
+        return [env.evaluate(a, b) for a, b in zip(tl, ktl)]
+
+    ref = np.array([math.nan if v is None else v for v in scalar()])
+    print("ADSR, %d voices, %d iterations" % (n, args.frames))
+    for name, fn in (("scalar", scalar),
+                     ("where", lambda: env.evaluate_array(t, kt)),
+                     ("segments", lambda: env.evaluate_array(t, kt, segments=True))):
+        if name != "scalar":
+            assert np.array_equal(fn(), ref, equal_nan=True), name
+        t0 = time.perf_counter()
+        for i in range(args.frames):
+            fn()
+        dt = (time.perf_counter() - t0) / args.frames
+        print("  %-8s %9.3f us/eval  %7.1f ns/voice" % (name, dt * 1e6, dt * 1e9 / n))
+
+def bench_ticks(args):
+    # Tick lateness at 120 BPM, plain sleep vs sleep+spin with adaptive
+    # compensation, optionally with Python threads competing for the GIL
+    stop = [False]
+    def load():
+        x = 0
+        while not stop[0]:
+            x += 1
+    loaders = [threading.Thread(target=load) for i in range(args.load)]
+    for t in loaders:
+        t.start()
+    try:
+        for name, spin, adaptive in (("sleep", 0, False), ("spin", BPMThread.SPIN, True)):
+            ticks = TickDispatcher()
+            if args.slow:
+                # A consumer slower than the tick rate must not delay the clock
+                ticks.add("slow", lambda tick, t, period: time.sleep(args.slow / 1000.))
+            bpm = BPMThread(ticks)
+            bpm.spin = spin
+            bpm.adaptive = adaptive
+            bpm.start()
+            time.sleep(args.seconds)
+            bpm.active = False
+            bpm.join()
+            ticks.stop()
+            st = bpm.lateness.summary()
+            print("%-6s n=%-5d mean=%7.3fms p50=%7.3fms p95=%7.3fms p99=%7.3fms max=%7.3fms comp=%.3fms" % (
+                  name, st["n"], st["mean"] * 1000, st["p50"] * 1000, st["p95"] * 1000,
+                  st["p99"] * 1000, st["max"] * 1000, bpm.comp * 1000))
+            for wname, st in sorted(ticks.stats().items()):
+                print("  %s: %d delivered, %d dropped" % (wname, st["delivered"], st["dropped"]))
+            if args.stats:
+                print(bpm.histogram.format(1000, "ms"))
+    finally:
+        stop[0] = True
+        for t in loaders:
+            t.join()
+
+# Synthetic drum loop: kick on every beat, snare on 2 and 4, hats on the
+# off-beats, over a noise floor. Returns (samples, beat times).
+def beat_track(bpm, seconds, rate, rng):
+    period = 60.0 / bpm
+    x = rng.normal(0, 0.01, int(seconds * rate)).astype(np.float32)
+    t = np.arange(int(0.3 * rate)) / rate
+    kick = np.sin(2 * np.pi * (50 * t + 70 * (1 - np.exp(-t * 30)) / 30)) * np.exp(-t * 12)
+    noise = rng.normal(0, 1, len(t))
+    snare = 0.4 * noise * np.exp(-t * 25) + 0.3 * np.sin(2 * np.pi * 190 * t) * np.exp(-t * 20)
+    hat = 0.15 * np.diff(noise, prepend=0) * np.exp(-t * 80)
+    start = rng.uniform(0.1, 0.6)
+    beats = []
+    k = 0
+    while True:
+        b = start + k * period + rng.normal(0, 0.002)
+        if b + period > seconds:
+            break
+        beats.append(b)
+        for sound, at in ((kick, b), (hat, b + period / 2)) + (((snare, b),) if k % 2 else ()):
+            i = int(at * rate)
+            n = min(len(sound), len(x) - i)
+            x[i:i + n] += sound[:n]
+        k += 1
+    return x, np.array(beats)
+
+class KickLog(object):
+    def __init__(self):
+        self.kicks = []
+        self.resets = []
+        self.tracker = None
+
+    def reset(self, t):
+        self.resets.append((t, self.tracker.now))
+
+    def kick(self, t):
+        self.kicks.append((t, self.tracker.now))
+
+def bench_beat(args):
+    rng = np.random.default_rng(args.seed)
+    tracks = []
+    if args.wav:
+        rate = None
+        blocks = []
+        for rate, x in read_wav(args.wav):
+            blocks.append(x)
+        ref = np.loadtxt(args.beats, ndmin=1) if args.beats else np.zeros(0)
+        tracks.append((args.wav, rate, np.concatenate(blocks), ref))
+    else:
+        for bpm in (90, 120, 128, 140, 174):
+            x, ref = beat_track(bpm, args.seconds * 6, 44100, rng)
+            tracks.append(("synth %d BPM" % bpm, 44100, x, ref))
+
+    # F-measure with the usual +-70 ms window; error and latency on matched
+    # kicks. Latency is from the true beat to the end of the block in which
+    # the kick was reported.
+    block = 512
+    for name, rate, x, ref in tracks:
+        log = KickLog()
+        tracker = log.tracker = BeatTracker(log, rate)
+        cost = []
+        for i in range(0, len(x), block):
+            t0 = time.perf_counter()
+            tracker.feed(x[i:i + block], i / rate)
+            cost.append(time.perf_counter() - t0)
+        cost = np.array(cost) * 1e6
+        print("%-16s kicks=%-4d resets=%-2d %5.1f BPM  block %6.1fus mean %7.1fus p99  (%.0fx realtime)" % (
+              name, len(log.kicks), len(log.resets), 60 / tracker.period if tracker.period else 0,
+              cost.mean(), np.percentile(cost, 99), block / rate * 1e6 / cost.mean()))
+        if not len(ref) or not log.kicks:
+            continue
+        kt = np.array([k for k, now in log.kicks])
+        now = np.array([now for k, now in log.kicks])
+        j = np.abs(kt[:, None] - ref[None]).argmin(1)
+        err = kt - ref[j]
+        hit = np.abs(err) <= 0.07
+        matched = len(set(j[hit].tolist()))
+        p, r = matched / len(kt), matched / len(ref)
+        f = 2 * p * r / (p + r) if p + r else 0
+        lat = now[hit] - ref[j[hit]]
+        print("  F=%.3f P=%.3f R=%.3f  err mean %+6.2fms abs %5.2fms  latency mean %5.1fms max %5.1fms" % (
+              f, p, r, err[hit].mean() * 1000, np.abs(err[hit]).mean() * 1000,
+              lat.mean() * 1000, lat.max() * 1000))
+
+# Tempo lock from taps vs. 24 PPQ MIDI clock at 128 BPM. Clock timing comes
+# either from arrival in the Qt loop (exponential delay plus occasional frame
+# stalls) or from ALSA queue timestamps. At every beat the BPM thread's
+# prediction for that beat, from input received half a beat earlier, is
+# compared with the true beat time.
+def bench_clock(args):
+    bpm = 128
+    period = 60.0 / bpm
+    seconds = args.seconds * 6
+    def taps(rng, t0):
+        return [(t0 + k * period + rng.normal(0, 0.015), "kick")
+                for k in range(1, int(seconds / period))]
+    def clocks(jitter):
+        def events(rng, t0):
+            ev = [(t0, "midi_start")]
+            for k in range(int(seconds / period * 24)):
+                ev.append((t0 + k * period / 24 + jitter(rng), "midi_clock"))
+            return ev
+        return events
+    arrival = clocks(lambda rng: rng.exponential(0.002) + (0.015 if rng.random() < 0.05 else 0))
+    stamped = clocks(lambda rng: rng.normal(0, 0.00005))
+
+    for name, source in (("tap", taps), ("clock arrival", arrival), ("clock stamped", stamped)):
+        rng = np.random.default_rng(args.seed)
+        b = BPMThread(None)
+        t0 = mono() + 1
+        if name == "tap":
+            b.reset(t0)
+        events = sorted(source(rng, t0))
+        errs = []
+        i = 0
+        for k in range(1, int(seconds / period)):
+            tb = t0 + k * period
+            while i < len(events) and events[i][0] < tb - period / 2:
+                getattr(b, events[i][1])(events[i][0])
+                i += 1
+            v = round(b.dll.evaluate(tb))
+            errs.append(b.dll.reverse(v) - tb)
+        errs = np.abs(errs)
+        bad = np.flatnonzero(errs > 0.005)
+        lock = (bad[-1] + 2) * period if len(bad) else period
+        tail = errs[len(errs) // 2:]
+        print("%-14s lock %6.2fs  phase err rms %6.2fms p95 %6.2fms max %6.2fms  tempo %8.3f BPM" % (
+              name, lock, math.sqrt((tail ** 2).mean()) * 1000, np.percentile(tail, 95) * 1000,
+              tail.max() * 1000, 60 / b.dll.period))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Headless render benchmark")
+    parser.add_argument("what", nargs="?", default="render", choices=("render", "adsr", "ticks", "beat", "clock"))
+    parser.add_argument("--backend", default="record", choices=("record", "null"))
+    parser.add_argument("--synth", default="pool", choices=list(SYNTHS.keys()))
+    parser.add_argument("--voice", default="all", choices=["all"] + list(VOICES.keys()))
+    parser.add_argument("--mode", default="span")
+    parser.add_argument("--frames", type=int, default=1000)
+    parser.add_argument("--channels", type=int, default=14)
+    parser.add_argument("--width", type=int, default=16)
+    parser.add_argument("--mult", type=int, default=1)
+    parser.add_argument("--retrigger", type=int, default=25)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fps", type=int, default=100)
+    parser.add_argument("--realtime", action="store_true", help="use the real clock")
+    parser.add_argument("--merge", action="store_true", help="merge overlapping segments")
+    parser.add_argument("--reorder", default="none", choices=REORDER_STRATEGIES)
+    parser.add_argument("--seconds", type=float, default=5, help="ticks: run time per mode; beat: 6x this per synthetic track")
+    parser.add_argument("--load", type=int, default=0, help="ticks: GIL-bound load threads")
+    parser.add_argument("--slow", type=float, default=0, help="ticks: consumer time per tick (ms)")
+    parser.add_argument("--wav", help="beat: reference track instead of synthetic loops")
+    parser.add_argument("--beats", help="beat: annotated beat times for --wav, one per line")
+    parser.add_argument("--budget", type=int, default=None, help="primitives per output")
+    parser.add_argument("--stats", action="store_true", help="dump render timing stats")
+    args = parser.parse_args(argv)
+
+    if args.what == "adsr":
+        bench_adsr(args)
+        return
+    if args.what == "ticks":
+        bench_ticks(args)
+        return
+    if args.what == "beat":
+        bench_beat(args)
+        return
+    if args.what == "clock":
+        bench_clock(args)
+        return
+
+    voices = VOICES.keys() if args.voice == "all" else [args.voice]
+    for voice in voices:
+        bench_render(args, voice)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
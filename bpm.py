@@ -1,22 +1,37 @@
 import threading, math, time, traceback, os
 
+from stats import RingStats, Histogram
+from evlog import log
+
+# All tempo timestamps are on the real monotonic clock (same source as
+# util.Clock); times handed to the synths go through util.from_mono, so they
+# follow a fake or offline render clock too
+def mono():
+    return time.monotonic_ns() * 1e-9
+
 # Based on timefilter.c from ffmpeg
+# period is in seconds per unit of value; interval is the expected time in
+# seconds between updates (one beat for taps, one clock for MIDI clock)
 class DLL(object):
-    def __init__(self, period, bandwidth):
-        o = 2 * math.pi * bandwidth * period
+    def __init__(self, period, bandwidth, interval=None):
+        if interval is None:
+            interval = period
+        o = 2 * math.pi * bandwidth * interval
 
         self.fb2 = 1 - math.exp(-(2**0.5) * o)
-        self.fb3 = (1 - math.exp(-o * o)) / period
+        self.fb3 = (1 - math.exp(-o * o)) / interval
         self.period = period
         self.count = 0
         self.lock = threading.Lock()
 
+    # Returns the loop error in seconds (0 for the first update)
     def update(self, timestamp, value):
         with self.lock:
             self.count += 1
             if self.count == 1:
                 self.cycle_time = timestamp
                 self.cycle_value = value
+                return 0.0
             else:
                 delta = value - self.cycle_value
                 self.cycle_time += self.period * delta
@@ -25,9 +40,8 @@ class DLL(object):
                 loop_error = timestamp - self.cycle_time
                 self.cycle_time += max(self.fb2, 1.0 / self.count) * loop_error
                 self.period += self.fb3 * loop_error
-                print("BPM %.4f ERR %.4f D %d" %(60.0 / self.period, loop_error, delta))
-                #print("ts %.04f v %.04f period %.04f err %.04f ct %.04f cv %.04f" % (
-                #timestamp, value, self.period, loop_error, self.cycle_time, self.cycle_value))
+                log.debug("bpm", "BPM %.4f ERR %.4f D %d", 60.0 / self.period, loop_error, delta)
+                return loop_error
     def evaluate(self, timestamp):  
         with self.lock:
             return self.cycle_value + (timestamp - self.cycle_time) / self.period
@@ -40,15 +54,31 @@ class DLL(object):
         self.cycle_time = timestamp
         self.cycle_value = value
 
+# Publishes every tick as parent.publish(tick, t, period) from this thread,
+# t being the scheduled tick time. publish() must not block; consumers belong
+# on a dispatch.TickDispatcher.
 class BPMThread(threading.Thread):
     BW = 0.05
     MUL = 24
     SLACK = 0.1 / MUL
+    # Ticks fire this far ahead of the beat grid to cover output latency
+    LATENCY = 0.02
+    # Sleep until this long before a tick, then spin
+    SPIN = 0.002
+    # Adaptive wakeup compensation: smoothing factor and limit
+    ADAPT = 0.1
+    MAX_COMP = 0.005
+    # MIDI clock loop bandwidth, and how long without clocks until taps
+    # take over again
+    CLOCK_BW = 0.1
+    CLOCK_FIT = 64
+    CLOCK_TIMEOUT = 0.5
+
     def __init__(self, parent):
         threading.Thread.__init__(self)
         self.parent = parent
         self.dll = DLL(0.5, self.BW)
-        self.dll.update(time.time(), 0)
+        self.dll.update(mono(), 0)
         self.needs_reset = False
         self.period = None
         self.last_kick = None
@@ -57,22 +87,37 @@ class BPMThread(threading.Thread):
         self.active = True
         self.tick = None
         self.lock = threading.Lock()
+        self.spin = self.SPIN
+        self.adaptive = True
+        self.comp = 0.0
+        self.lateness = RingStats(4096)
+        self.histogram = Histogram(-0.001, 0.010, 110)
+        self.clock_last = None
+        self.clock_pos = None
+        self.clock_count = 0
+        self.clock_start = False
+        self.running = False
+        self.clock_error = RingStats(4096)
 
     def reset(self, t=None):
+        if t is None:
+            t = mono()
+        if self.slaved(t):
+            return
         with self.lock:
-            if t is None:
-                t = time.time()
             self.dll.reset(t, 0)
             self.tick = None
             self.needs_reset = True
             self.last_kick = t
 
     def kick(self, t=None):
-        if self.last_kick and (time.time() - self.last_kick) < 0.1:
+        if t is None:
+            t = mono()
+        if self.slaved(t):
+            return
+        if self.last_kick and (t - self.last_kick) < 0.1:
             return
         with self.lock:
-            if t is None:
-                t = time.time()
             if self.needs_reset and (t - self.last_kick) < 1:
                 self.period = t - self.last_kick
                 self.dll = DLL(self.period, self.BW)
@@ -83,7 +128,7 @@ class BPMThread(threading.Thread):
                 self.needs_reset = False
                 cur = self.dll.evaluate(t)
                 nearest = round(cur)
-                print(t, nearest)
+                log.debug("bpm", "kick %.4f step %d", t, nearest)
                 if self.last_kick_step == nearest:
                     self.lk_count += 1
                     if self.lk_count > 2:
@@ -94,22 +139,115 @@ class BPMThread(threading.Thread):
                 self.last_kick_step = nearest
             self.last_kick = t
 
+    # MIDI clock (24 PPQ, same as MUL). While clocks keep arriving the DLL is
+    # slaved to them and taps are ignored. Without a START the current phase
+    # is kept; START makes the next clock the downbeat of beat 0. STOP only
+    # updates the transport state: clocks keep running while stopped, and so
+    # do our ticks.
+    def slaved(self, t):
+        return self.clock_last is not None and t - self.clock_last < self.CLOCK_TIMEOUT
+
+    def midi_start(self, t=None):
+        with self.lock:
+            self.clock_pos = None
+            self.clock_start = True
+            self.running = True
+
+    def midi_continue(self, t=None):
+        self.running = True
+
+    def midi_stop(self, t=None):
+        self.running = False
+
+    def midi_clock(self, t=None):
+        if t is None:
+            t = mono()
+        with self.lock:
+            if not self.slaved(t):
+                self.clock_pos = None
+                self.clock_count = 0
+            if self.clock_pos is None:
+                # (Re)lock: START means beat 0, otherwise the nearest tick
+                if self.clock_start:
+                    pos = 0
+                else:
+                    pos = round(self.dll.evaluate(t) * self.MUL)
+                self.clock_start = False
+                self.clock_count = 0
+            else:
+                pos = self.clock_pos + 1
+            self.clock_pos = pos
+            self.clock_count += 1
+            if self.clock_count == 1:
+                self.clock_fit = []
+            if self.clock_count <= self.CLOCK_FIT:
+                # Until the loop has settled, seed it from a least-squares fit
+                # over all clocks so far instead of one noisy interval
+                self.clock_fit.append((t, pos / self.MUL))
+                if self.clock_count >= 2 and self.clock_count & (self.clock_count - 1) == 0:
+                    self.fit_clock()
+                elif self.clock_count > 2:
+                    self.dll.update(t, pos / self.MUL)
+            else:
+                self.clock_error.add(self.dll.update(t, pos / self.MUL))
+            self.clock_last = t
+
+    def fit_clock(self):
+        n = len(self.clock_fit)
+        mt = sum(t for t, v in self.clock_fit) / n
+        mv = sum(v for t, v in self.clock_fit) / n
+        period = (sum((t - mt) * (v - mv) for t, v in self.clock_fit) /
+                  sum((v - mv) ** 2 for t, v in self.clock_fit))
+        t, v = self.clock_fit[-1]
+        self.dll = DLL(period, self.CLOCK_BW, period / self.MUL)
+        self.dll.update(mt + (v - mv) * period, v)
+        self.tick = None
+
+    # Time at which tick is published, including the LATENCY lead; for ticks
+    # ahead of the current one this is a prediction from the DLL
+    def tick_time(self, tick):
+        return self.dll.reverse(tick / self.MUL) - self.LATENCY
+
+    # Coarse sleep until spin + comp before the target, then busy-wait.
+    # comp tracks how late the coarse wakeups come back (GIL handoff, timer
+    # slack), so the spin starts in time.
+    def sleep_until(self, target):
+        wake = target - self.spin - self.comp
+        left = wake - mono()
+        if left > 0:
+            time.sleep(left)
+            over = mono() - wake
+            if self.adaptive:
+                self.comp += self.ADAPT * (over - self.comp)
+                self.comp = min(self.MAX_COMP, max(0.0, self.comp))
+        now = mono()
+        while now < target:
+            now = mono()
+        return now
+
+    def jitter_stats(self):
+        return {
+            "lateness": self.lateness.summary(),
+            "histogram": self.histogram.bins(),
+            "compensation": self.comp,
+            "clock_error": self.clock_error.summary(),
+        }
 
     def run(self):
         try:
-            compensation = 0.02
             while self.active:
-                now = time.time()
+                now = mono()
                 with self.lock:
                     if self.tick is None:
-                        self.tick = int(self.dll.evaluate(now + compensation) * self.MUL + 1)
+                        self.tick = int(self.dll.evaluate(now + self.LATENCY) * self.MUL + 1)
                     else:
                         self.tick += 1
-                    next_t = self.dll.reverse(self.tick / self.MUL) - compensation
-                    left = next_t - time.time()
+                    target = self.tick_time(self.tick)
                     tick = self.tick
-                time.sleep(max(0, left))
-                self.parent.clock(tick, self.dll.period / self.MUL)
+                late = self.sleep_until(target) - target
+                self.lateness.add(late)
+                self.histogram.add(late)
+                self.parent.publish(tick, target, self.dll.period / self.MUL)
         except:
             traceback.print_exc()
             os.abort()
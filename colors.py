@@ -1,3 +1,5 @@
+import numpy as np
+
 PALETTE = [
     0x000000,
     0xffffff,
@@ -16,3 +18,72 @@ PALETTE = [
     0xff00ff,
     0xff0080,
 ]
+
+# 256-entry lookup tables. Everything that maps a color component through a
+# curve goes through one of these, built once when its inputs change.
+
+def _clamp8(v):
+    return int(min(255, max(0, v)))
+
+# Palette gamma (see util.gamma)
+GAMMA = np.array([_clamp8(((i / 255.0) ** 2.0) * 255.0) for i in range(256)], dtype=np.uint32)
+
+# Intensity level -> grey color
+GREY = [i * 0x010101 for i in range(256)]
+
+# Subtractive fade used by DropVoice: entry i is the color with
+# max(r, g, b) * i / 255 taken off each component
+_fades = {}
+
+def fade_table(color):
+    table = _fades.get(color)
+    if table is None:
+        r, g, b = color >> 16, (color >> 8) & 0xff, color & 0xff
+        cmax = max(r, g, b)
+        table = []
+        for i in range(256):
+            v = i / 255.0
+            table.append((_clamp8(r - cmax * v) << 16) | (_clamp8(g - cmax * v) << 8) |
+                         _clamp8(b - cmax * v))
+        table = _fades[color] = np.array(table, dtype=np.uint32)
+    return table
+
+# Per-output diode calibration. Each component is mapped as
+#   0 -> 0, i -> lo + (hi - lo) * (i * bright / 255 / 255) ** gamma
+# so the master brightness is folded into the same table. Tables are
+# rebuilt only when the curve or brightness changes, on whichever thread
+# changes them, and published as one (identity, luts) tuple so the render
+# thread never sees a half-built set.
+class Calibration(object):
+    def __init__(self, gamma=(1.0, 1.0, 1.0), lo=(0, 0, 0), hi=(255, 255, 255)):
+        self.gamma = tuple(gamma)
+        self.lo = tuple(lo)
+        self.hi = tuple(hi)
+        self.bright = 255
+        self.build()
+
+    def build(self):
+        bright = self.bright
+        identity = (self.gamma == (1.0, 1.0, 1.0) and self.lo == (0, 0, 0) and
+                    self.hi == (255, 255, 255) and bright == 255)
+        luts = []
+        for shift, gamma, lo, hi in zip((16, 8, 0), self.gamma, self.lo, self.hi):
+            lut = [0]
+            for i in range(1, 256):
+                v = ((i * bright) // 255) / 255.0
+                lut.append(_clamp8(round(lo + (hi - lo) * v ** gamma)) if v > 0 else 0)
+            luts.append(np.array(lut, dtype=np.uint32) << shift)
+        self.tables = (identity, tuple(luts))
+
+    @property
+    def identity(self):
+        return self.tables[0]
+
+    def set_bright(self, bright):
+        if bright != self.bright:
+            self.bright = bright
+            self.build()
+
+    def apply(self, colors, luts=None):
+        lr, lg, lb = self.tables[1] if luts is None else luts
+        return lr[(colors >> 16) & 0xff] | lg[(colors >> 8) & 0xff] | lb[colors & 0xff]
@@ -1,16 +1,57 @@
-import select, time
+import select, time, threading
 
 from pyalsa.alsaseq import *
-from PyQt5.QtCore import QSocketNotifier
+from PyQt5.QtCore import QObject, QSocketNotifier, QTimer, pyqtSignal
+
+from bpm import mono
+from evlog import log
+from keymap import load_keymap
+
+# Carries event batches from the input thread to the Qt thread (queued
+# connection, since the receiver lives in the Qt thread)
+class InputBridge(QObject):
+    events = pyqtSignal(object)
+
+# Optional MIDI input thread. It sleeps in poll() on the sequencer fds, so
+# input is read as soon as it arrives regardless of what the Qt loop is
+# doing. Events the controller can handle off the GUI (realtime_event) are
+# dispatched right here; the rest go to the Qt thread as one batch.
+class MIDIInputThread(threading.Thread):
+    def __init__(self, controller, timeout=100):
+        threading.Thread.__init__(self, name="midi-in", daemon=True)
+        self.controller = controller
+        self.timeout = timeout
+        self.active = True
+        self.poller = select.poll()
+
+        poller = self.poller
+        class RegisterPoll(object):
+            def register(fd, events):
+                if events & select.POLLIN:
+                    poller.register(fd, select.POLLIN)
+
+        controller.seq.register_poll(RegisterPoll)
+
+    def run(self):
+        ctl = self.controller
+        while self.active:
+            if not self.poller.poll(self.timeout):
+                continue
+            events = [ev for ev in ctl.receive() if not ctl.realtime_event(ev)]
+            if events:
+                ctl.bridge.events.emit(events)
 
 class MIDIController(object):
-    def __init__(self, parent, in_ports, out_ports):
+    def __init__(self, parent, in_ports, out_ports, seq=None):
         self.parent = parent
 
-        self.seq = seq = Sequencer(name = 'default',
-                                   clientname = "lvj",
-                                   streams = SEQ_OPEN_DUPLEX,
-                                   mode = SEQ_NONBLOCK)
+        # seq may be a stand-in with the same interface (midirec.FakeSequencer)
+        if seq is None:
+            seq = Sequencer(name = 'default',
+                            clientname = "lvj",
+                            streams = SEQ_OPEN_DUPLEX,
+                            mode = SEQ_NONBLOCK)
+        self.seq = seq
 
         caps = SEQ_PORT_CAP_WRITE | SEQ_PORT_CAP_SUBS_WRITE
         for n in in_ports:
@@ -28,6 +69,25 @@ class MIDIController(object):
                                         caps = caps)
             setattr(self, n, port)
 
+        # Running queue for real-time input stamps (see connect_stamped)
+        self.queue = seq.create_queue()
+        seq.start_queue(self.queue)
+        seq.drain_output()
+        self.queue_t0 = mono()
+
+        # Shadow of what the device LEDs show, keyed by (port, ch, note).
+        # out_lock serializes output from the Qt and tick threads.
+        self.leds = {}
+        self.out_lock = threading.Lock()
+        self.leds_pending = False
+        self.led_sent = 0
+        self.led_skipped = 0
+        self.discrete_ccs = set()
+        self.cc_coalesced = 0
+        # midirec.MIDIRecorder capturing raw input, before coalescing
+        self.recorder = None
+        self.input_thread = None
+
         self.notifiers = []
         
         class RegisterNotifier(object):
@@ -47,37 +107,168 @@ class MIDIController(object):
         
         self.seq.register_poll(RegisterNotifier)
     
+    # Continuous controllers (CC, pitch bend) are coalesced per
+    # (port, channel, param) within each receive_events() batch, so only the
+    # latest value of a knob sweep is delivered. Pending values are flushed,
+    # in first-seen order, before any other event and at the end of the
+    # batch, so they keep their order relative to notes. Button-style CCs
+    # listed in discrete_ccs are delivered one by one.
     def poll(self):
-        for ev in self.seq.receive_events(0,100):
+        self.handle_events(self.receive())
+
+    def receive(self):
+        events = self.seq.receive_events(0,100)
+        if self.recorder:
+            for ev in events:
+                self.recorder.add(ev.type, int(ev.dest[1]), ev.get_data(), self.event_time(ev))
+        return events
+
+    def handle_events(self, events):
+        pending = {}
+        for ev in events:
             data = ev.get_data()
             port = int(ev.dest[1])
+            if ev.type == SEQ_EVENT_CONTROLLER:
+                log.debug("midi", "CTL %d %d %d %d", port, data["control.channel"],
+                          data["control.param"], data["control.value"])
+                key = (port, data["control.channel"], data["control.param"])
+                if key in self.discrete_ccs:
+                    self.flush_ccs(pending)
+                    self.ctl_event(*(key + (data["control.value"],)))
+                    continue
+                if key in pending:
+                    self.cc_coalesced += 1
+                pending[key] = data["control.value"]
+                continue
+            elif ev.type == SEQ_EVENT_PITCHBEND:
+                log.debug("midi", "PB %d %d %d", port, data["control.channel"],
+                          data["control.value"])
+                key = (port, data["control.channel"], None)
+                if key in pending:
+                    self.cc_coalesced += 1
+                pending[key] = data["control.value"]
+                continue
+
+            if pending:
+                self.flush_ccs(pending)
             if ev.type in (SEQ_EVENT_NOTEON, SEQ_EVENT_NOTEOFF):
-                print("NOTE", port, data["note.channel"],
-                                "-+"[ev.type == SEQ_EVENT_NOTEON], data["note.note"],
-                                data["note.velocity"])
+                log.debug("midi", "NOTE %d %d %s%d %d", port, data["note.channel"],
+                          "-+"[ev.type == SEQ_EVENT_NOTEON], data["note.note"],
+                          data["note.velocity"])
                 self.note_event(ev.dest[1], data["note.channel"],
                                 ev.type == SEQ_EVENT_NOTEON, data["note.note"],
-                                data["note.velocity"])
-            elif ev.type == SEQ_EVENT_CONTROLLER:
-                print("CTL", port, data["control.channel"],
-                                data["control.param"], data["control.value"])
-                self.ctl_event(ev.dest[1], data["control.channel"],
-                                data["control.param"], data["control.value"])
-            elif ev.type == SEQ_EVENT_PITCHBEND:
-                print("PB", port, data["control.channel"],
-                                data["control.value"])
-                self.pb_event(ev.dest[1], data["control.channel"],
-                                data["control.value"])
-            #print(ev.get_data())
+                                data["note.velocity"], self.event_time(ev))
+            elif ev.type == SEQ_EVENT_CLOCK:
+                self.clock_event(port, self.event_time(ev))
+            elif ev.type in (SEQ_EVENT_START, SEQ_EVENT_CONTINUE, SEQ_EVENT_STOP):
+                self.transport_event(port, ev.type, self.event_time(ev))
+        if pending:
+            self.flush_ccs(pending)
+
+    # Moves input handling from the Qt socket notifiers to a MIDIInputThread.
+    # Must be called from the Qt thread.
+    def start_input_thread(self):
+        for sn in self.notifiers:
+            sn.setEnabled(False)
+        self.bridge = InputBridge()
+        self.bridge.events.connect(self.handle_events)
+        self.input_thread = MIDIInputThread(self)
+        self.input_thread.start()
+
+    def stop_input_thread(self):
+        if self.input_thread:
+            self.input_thread.active = False
+            self.input_thread.join()
+
+    # Called from the input thread for every event; returns True if the
+    # event was handled there. Only clock and transport by default, which
+    # must not touch Qt objects.
+    def realtime_event(self, ev):
+        if ev.type == SEQ_EVENT_CLOCK:
+            self.clock_event(int(ev.dest[1]), self.event_time(ev))
+        elif ev.type in (SEQ_EVENT_START, SEQ_EVENT_CONTINUE, SEQ_EVENT_STOP):
+            self.transport_event(int(ev.dest[1]), ev.type, self.event_time(ev))
+        else:
+            return False
+        return True
 
-    def send_note(self, port, ch, state, note, vel):
+    def flush_ccs(self, pending):
+        for (port, ch, param), value in pending.items():
+            if param is None:
+                self.pb_event(port, ch, value)
+            else:
+                self.ctl_event(port, ch, param, value)
+        pending.clear()
+
+    # Subscribes src to one of our ports with real-time stamps from our queue,
+    # so clock timing does not depend on when the Qt loop gets to poll()
+    def connect_stamped(self, src, port):
+        self.seq.connect_ports(src, (self.seq.client_id, port), self.queue, 0, 1, 1)
+
+    def event_time(self, ev):
+        if ev.queue == self.queue and ev.timestamp == SEQ_TIME_STAMP_REAL:
+            t = ev.time
+            if isinstance(t, tuple):
+                t = t[0] + t[1] * 1e-9
+            return self.queue_t0 + t
+        return mono()
+
+    def send_realtime(self, port, type):
+        event = SeqEvent(type=type)
+        event.source = (self.seq.client_id, port)
+        with self.out_lock:
+            self.seq.output_event(event)
+            self.seq.drain_output()
+
+    def queue_note(self, port, ch, state, note, vel):
         event = SeqEvent(type=(SEQ_EVENT_NOTEOFF if not state else SEQ_EVENT_NOTEON))
         event.set_data({'note.channel': ch, 'note.note': note, 'note.velocity': vel})
         event.source = (self.seq.client_id, port)
         self.seq.output_event(event)
-        self.seq.drain_output()
+
+    def send_note(self, port, ch, state, note, vel):
+        with self.out_lock:
+            self.queue_note(port, ch, state, note, vel)
+            self.seq.drain_output()
+
+    # Sets a batch of LEDs as (note, vel) pairs: only pads whose value differs
+    # from the shadow state are sent, and the output is drained once
+    def set_leds(self, port, ch, leds):
+        with self.out_lock:
+            sent = 0
+            for note, vel in leds:
+                key = (port, ch, note)
+                if self.leds.get(key) == vel:
+                    continue
+                self.leds[key] = vel
+                self.queue_note(port, ch, True, note, vel)
+                sent += 1
+            if sent:
+                self.seq.drain_output()
+            self.led_sent += sent
+            self.led_skipped += len(leds) - sent
+
+    # The device lost its LED state (mode change); resend everything next time
+    def invalidate_leds(self):
+        with self.out_lock:
+            self.leds.clear()
+
+    # Coalesces LED refreshes requested during one Qt event loop iteration
+    # (e.g. every channel of a scene being loaded) into one update_leds()
+    def request_leds(self):
+        if not self.leds_pending:
+            self.leds_pending = True
+            QTimer.singleShot(0, self.flush_leds)
+
+    def flush_leds(self):
+        self.leds_pending = False
+        self.update_leds()
+
+    def update_leds(self):
+        pass
     
-    def note_event(self, port, ch, state, note, v):
+    # t is the arrival time of the event (see event_time)
+    def note_event(self, port, ch, state, note, v, t=None):
         pass
 
     def ctl_event(self, port, ch, ctl, v):
@@ -86,6 +277,12 @@ class MIDIController(object):
     def pb_event(self, port, ch, v):
         pass
 
+    def clock_event(self, port, t):
+        pass
+
+    def transport_event(self, port, type, t):
+        pass
+
 ST_OFF = 0
 ST_HOLD = 1
 ST_ACTIVE = 2
@@ -93,8 +290,12 @@ ST_REL = 3
 
 class LaunchKeyController(MIDIController):
     
-    def __init__(self, parent):
-        super().__init__(parent, ["key", "ctl"], ["fb"])
+    def __init__(self, parent, clock_out=False, keymap="keymap.json", seq=None):
+        super().__init__(parent, ["key", "ctl", "sync"], ["fb"] + (["clock"] if clock_out else []),
+                         seq)
+        self.keymap = load_keymap(keymap, {"key": self.key, "ctl": self.ctl, "fb": self.fb})
+        self.clock_out = clock_out
+        self.clock_started = False
         time.sleep(0.2)
         self.send_note(self.fb, 15, True, 12, 127)
         self.send_note(self.fb, 15, True, 13, 0)
@@ -120,125 +321,102 @@ class LaunchKeyController(MIDIController):
     def trigger_note(self, state, start, end, vel, **kw):
         self.parent.cur_scene.ctl_key(state, start, end, vel, **kw)
 
-    def note_event(self, port, ch, state, note, v):
+    def note_event(self, port, ch, state, note, v, t=None):
+        pad = self.keymap.pads.get((port, ch, note))
+        if pad is not None:
+            self.pad_event(pad, state, v, t)
+            return
+        spans = self.keymap.keys.get((port, ch, note))
+        if spans is not None:
+            for start, end, area in spans:
+                self.trigger_note(state, start, end, v, area=area, stamp=t)
+
+    # Key notes only queue synth events, and tap tempo pads only reach the
+    # BPM thread (unless the color picker is up), so both are safe to run
+    # on the input thread
+    def realtime_event(self, ev):
+        if super().realtime_event(ev):
+            return True
+        if ev.type not in (SEQ_EVENT_NOTEON, SEQ_EVENT_NOTEOFF):
+            return False
+        data = ev.get_data()
+        key = (int(ev.dest[1]), data["note.channel"], data["note.note"])
+        pad = self.keymap.pads.get(key)
+        if pad is not None:
+            if pad[2] not in ("bpm_reset", "bpm_kick") or self.cpick_state != ST_OFF:
+                return False
+        elif key not in self.keymap.keys:
+            return False
+        self.note_event(key[0], key[1], ev.type == SEQ_EVENT_NOTEON, key[2],
+                        data["note.velocity"], self.event_time(ev))
+        return True
+
+    def pad_event(self, pad, state, v, t=None):
         cursc = self.parent.cur_scene
         curch = cursc.cur_channel
+        slot, color, action = pad
 
-        if port == self.ctl:
-            if ch == 15:
-                if note == 13 and v == 0:
-                    #self.send_note(self.fb, 15, True, 13, 127)
-                    self.update_leds()
-                    return
+        if action == "mode":
+            if v == 0:
+                #self.send_note(self.fb, 15, True, 13, 127)
+                self.invalidate_leds()
+                self.update_leds()
+            return
 
-                if note == 15 and v == 0:
-                    self.send_note(self.fb, 15, True, 15, 127)
-                    self.send_note(self.fb, 15, True, 16, 127)
-                    self.update_leds()
-                    return
-
-                if note == 120:
-                    if state:
-                        if self.cpick_state in (ST_REL, ST_OFF):
-                            self.cpick_state = ST_HOLD
-                        elif self.cpick_state in (ST_HOLD, ST_ACTIVE):
-                            self.cpick_state = ST_OFF
-                    else:
-                        if self.cpick_state == ST_HOLD:
-                            self.cpick_state = ST_ACTIVE
-                        elif self.cpick_state == ST_REL:
-                            self.cpick_state = ST_OFF
-                    self.update_leds()
-                    return
+        if action == "incontrol":
+            if v == 0:
+                self.send_note(self.fb, 15, True, 15, 127)
+                self.send_note(self.fb, 15, True, 16, 127)
+                self.invalidate_leds()
+                self.update_leds()
+            return
+
+        if action == "cpick":
+            if state:
+                if self.cpick_state in (ST_REL, ST_OFF):
+                    self.cpick_state = ST_HOLD
+                elif self.cpick_state in (ST_HOLD, ST_ACTIVE):
+                    self.cpick_state = ST_OFF
+            else:
+                if self.cpick_state == ST_HOLD:
+                    self.cpick_state = ST_ACTIVE
+                elif self.cpick_state == ST_REL:
+                    self.cpick_state = ST_OFF
+            self.update_leds()
+            return
+
+        if action == "selector":
+            self.selector = state
+            self.update_leds()
+            return
 
-                if note == 104:
-                    self.selector = state
+        if action == "alt":
+            self.alt = v > 0
+            return
+
+        if self.cpick_state == ST_REL and not state and color is not None:
+            self.cpick_state = ST_OFF
+            return
+
+        if self.cpick_state == ST_OFF:
+            if slot is not None:
+                if self.alt or self.selector:
+                    cursc.focusChannel(slot)
                     self.update_leds()
+                else:
+                    cursc.channels[slot].ctl_active(state, v)
+            if state and action == "bpm_reset":
+                self.parent.bpm.reset(t)
+            if state and action == "bpm_kick":
+                self.parent.bpm.kick(t)
 
-                if note == 16:
-                    self.alt = v > 0
-                    return
-                
-                if self.cpick_state == ST_REL and not state and (96 <= note <= 103 or 112 <= note <= 119):
-                    self.cpick_state = ST_OFF
-                    return
-
-                if self.cpick_state == ST_OFF:
-                    if 96 <= note <= 102:
-                        if self.alt or self.selector:
-                            cursc.focusChannel(note - 96)
-                            self.update_leds()
-                        else:
-                            cursc.channels[note - 96].ctl_active(state, v)
-                    elif 112 <= note <= 118:
-                        if self.alt or self.selector:
-                            cursc.focusChannel(note - 112 + 7)
-                            self.update_leds()
-                        else:
-                            cursc.channels[note - 112 + 7].ctl_active(state, v)
-                    if state and note == 103:
-                        self.parent.bpm.reset()
-                    if state and note == 119:
-                        self.parent.bpm.kick()
-                    return
-
-                elif self.cpick_state in (ST_HOLD, ST_ACTIVE) and state:
-                    if 96 <= note <= 103 or 112 <= note <= 119:
-                        color = note - 96 if note <= 103 else note - 112 + 8
-                        if self.cpick_state == ST_HOLD:
-                            self.cpick_state = ST_REL
-
-                        curch.ctl_color(color)
-                        self.update_leds()
-                    return
-
-        if port == self.key:
-                if note == 48:   self.trigger_note(state, 0/10, 1/10, v, area="left")
-                elif note == 50: self.trigger_note(state, 1/10, 2/10, v, area="left")
-                elif note == 52: self.trigger_note(state, 2/10, 3/10, v, area="left")
-                elif note == 53: self.trigger_note(state, 3/10, 4/10, v, area="left")
-                elif note == 55: self.trigger_note(state, 4/10, 5/10, v, area="left")
-
-                elif note == 49: self.trigger_note(state, 0/10, 2.5/10, v, area="left")
-                elif note == 51: self.trigger_note(state, 2.5/10, 5/10, v, area="left")
-
-                elif note == 57: self.trigger_note(state, 5/10, 6/10, v, area="left")
-                elif note == 59: self.trigger_note(state, 6/10, 7/10, v, area="left")
-                elif note == 60: self.trigger_note(state, 7/10, 8/10, v, area="left")
-                elif note == 62: self.trigger_note(state, 8/10, 9/10, v, area="left")
-                elif note == 64: self.trigger_note(state, 9/10, 10/10, v, area="left")
-
-                elif note == 61: self.trigger_note(state, 5/10, 7.5/10, v, area="left")
-                elif note == 63: self.trigger_note(state, 7.5/10, 10/10, v, area="left")
-
-                elif note == 54: self.trigger_note(state, 0/10, 5/10, v, area="left")
-                elif note == 56: self.trigger_note(state, 0/10, 10/10, v, area="left")
-                elif note == 58: self.trigger_note(state, 5/10, 10/10, v, area="left")
-
-                elif note == 65:
-                    self.trigger_note(state, 4/10, 5/10, v, area="right")
-                    self.trigger_note(state, 5/10, 6/10, v, area="right")
-                elif note == 67:
-                    self.trigger_note(state, 3/10, 4/10, v, area="right")
-                    self.trigger_note(state, 6/10, 7/10, v, area="right")
-                elif note == 69:
-                    self.trigger_note(state, 2/10, 3/10, v, area="right")
-                    self.trigger_note(state, 7/10, 8/10, v, area="right")
-                elif note == 71:
-                    self.trigger_note(state, 1/10, 2/10, v, area="right")
-                    self.trigger_note(state, 8/10, 9/10, v, area="right")
-                elif note == 72:
-                    self.trigger_note(state, 0/10, 1/10, v, area="right")
-                    self.trigger_note(state, 9/10, 10/10, v, area="right")
-
-                elif note == 66:
-                    self.trigger_note(state, 2.5/10, 5/10, v, area="right")
-                    self.trigger_note(state, 5/10, 7.5/10, v, area="right")
-                elif note == 68:
-                    self.trigger_note(state, 0/10, 10/10, v, area="right")
-                elif note == 70:
-                    self.trigger_note(state, 0/10, 2.5/10, v, area="right")
-                    self.trigger_note(state, 7.5/10, 10/10, v, area="right")
+        elif self.cpick_state in (ST_HOLD, ST_ACTIVE) and state:
+            if color is not None:
+                if self.cpick_state == ST_HOLD:
+                    self.cpick_state = ST_REL
+
+                curch.ctl_color(color)
+                self.update_leds()
 
     def ctl_event(self, port, ch, ctl, v):
         cursc = self.parent.cur_scene
@@ -271,6 +449,26 @@ class LaunchKeyController(MIDIController):
     def pb_event(self, port, ch, v):
         pass
 
+    def clock_event(self, port, t):
+        self.parent.bpm.midi_clock(t)
+
+    def transport_event(self, port, type, t):
+        if type == SEQ_EVENT_START:
+            self.parent.bpm.midi_start(t)
+        elif type == SEQ_EVENT_CONTINUE:
+            self.parent.bpm.midi_continue(t)
+        elif type == SEQ_EVENT_STOP:
+            self.parent.bpm.midi_stop(t)
+
+    # Tick consumer: 24 PPQ clock out, with START sent on the first bar line
+    def send_clock(self, tick, t, period):
+        if not self.clock_started:
+            if tick % (4 * 24):
+                return
+            self.send_realtime(self.clock, SEQ_EVENT_START)
+            self.clock_started = True
+        self.send_realtime(self.clock, SEQ_EVENT_CLOCK)
+
     def clock(self, tick):
         tick -= 2
         beat = tick // 24
@@ -282,26 +480,40 @@ class LaunchKeyController(MIDIController):
             self.bpm_color2 = 17
         if self.cpick_state in (ST_HOLD, ST_ACTIVE):
             return
-        self.send_note(self.fb, 15, True, 103, self.bpm_color)
-        self.send_note(self.fb, 15, True, 119, self.bpm_color2)
+        self.bpm_leds([])
+
+    def bpm_leds(self, leds):
+        km = self.keymap
+        for action, color in (("bpm_reset", self.bpm_color), ("bpm_kick", self.bpm_color2)):
+            if action in km.action_note:
+                leds.append((km.action_note[action], color))
+        self.set_leds(km.led_port, km.led_channel, leds)
 
     def update_leds(self):
+        km = self.keymap
+        leds = []
         if self.cpick_state in (ST_HOLD, ST_ACTIVE):
-            for i in range(16):
-                key = 96 + i if i < 8 else 112 + i - 8
+            for i, key in km.color_note.items():
                 active = i == self.parent.cur_scene.cur_channel.state["color"]
-                self.send_note(self.fb, 15, True, key, self.colormap(i, 2 if active else 0))
-            self.send_note(self.fb, 15, True, 120, 60)
+                leds.append((key, self.colormap(i, 2 if active else 0)))
+            if "cpick" in km.action_note:
+                leds.append((km.action_note["cpick"], 60))
+            self.set_leds(km.led_port, km.led_channel, leds)
             return
 
-        self.send_note(self.fb, 15, True, 104, 60 if self.selector else 63)
-        self.send_note(self.fb, 15, True, 120, 63)
+        if "selector" in km.action_note:
+            leds.append((km.action_note["selector"], 60 if self.selector else 63))
+        if "cpick" in km.action_note:
+            leds.append((km.action_note["cpick"], 63))
 
         cursc = self.parent.cur_scene
         if cursc is None:
+            self.set_leds(km.led_port, km.led_channel, leds)
             return
         for i, ch in enumerate(cursc.channels):
-            key = 96 + i if i < 7 else 112 + i - 7
+            key = km.slot_note.get(i)
+            if key is None:
+                continue
             hue = ch.state["color"]
             bright = 0
             if ch.state["active"]:
@@ -311,7 +523,6 @@ class LaunchKeyController(MIDIController):
                 if hue == 0:
                     hue = 1
                     bright = 1
-            self.send_note(self.fb, 15, True, key, self.colormap(hue, bright))
+            leds.append((key, self.colormap(hue, bright)))
 
-        self.send_note(self.fb, 15, True, 103, self.bpm_color)
-        self.send_note(self.fb, 15, True, 119, self.bpm_color2)
+        self.bpm_leds(leds)
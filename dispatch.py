@@ -0,0 +1,82 @@
+import threading, collections, traceback
+
+from stats import RingStats
+from bpm import mono
+
+# Tick consumer running on its own thread. The timing thread only appends
+# (tick, t, period) and wakes the worker; whatever the consumer does cannot
+# delay the next tick.
+#   coalesce - only the most recent pending tick is delivered (LED feedback)
+#   max_lag  - every tick is delivered in order, but if more than max_lag
+#              ticks are pending the oldest are dropped (generators)
+class TickWorker(threading.Thread):
+    def __init__(self, name, fn, coalesce=False, max_lag=4):
+        threading.Thread.__init__(self, name="tick-" + name, daemon=True)
+        self.fn = fn
+        self.coalesce = coalesce
+        self.max_lag = 1 if coalesce else max_lag
+        self.pending = collections.deque()
+        self.cond = threading.Condition()
+        self.active = True
+        self.dropped = 0
+        self.delivered = 0
+        self.lag = RingStats(1024)
+
+    def publish(self, tick, t, period):
+        with self.cond:
+            self.pending.append((tick, t, period))
+            while len(self.pending) > self.max_lag:
+                self.pending.popleft()
+                self.dropped += 1
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.active = False
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.active and not self.pending:
+                    self.cond.wait()
+                if not self.active:
+                    return
+                tick, t, period = self.pending.popleft()
+            self.lag.add(mono() - t)
+            try:
+                self.fn(tick, t, period)
+            except:
+                traceback.print_exc()
+            self.delivered += 1
+
+    def stats(self):
+        return {
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "lag": self.lag.summary(),
+        }
+
+# Fans ticks from BPMThread out to the registered workers
+class TickDispatcher(object):
+    def __init__(self):
+        self.workers = {}
+
+    def add(self, name, fn, coalesce=False, max_lag=4):
+        worker = TickWorker(name, fn, coalesce, max_lag)
+        self.workers[name] = worker
+        worker.start()
+        return worker
+
+    def publish(self, tick, t, period):
+        for worker in self.workers.values():
+            worker.publish(tick, t, period)
+
+    def stop(self):
+        for worker in self.workers.values():
+            worker.stop()
+        for worker in self.workers.values():
+            worker.join()
+
+    def stats(self):
+        return {name: w.stats() for name, w in self.workers.items()}
@@ -0,0 +1,52 @@
+PRIM_LINE = 0
+PRIM_DOT = 1
+
+# Same arithmetic as libol's color multiply, so recorded colors match what
+# pylase would have computed with its own color stack.
+def colormul(a, b):
+    return (((((a >> 16) & 0xff) * ((b >> 16) & 0xff)) // 255) << 16 |
+            ((((a >> 8) & 0xff) * ((b >> 8) & 0xff)) // 255) << 8 |
+            ((a & 0xff) * (b & 0xff)) // 255)
+
+def grey(v):
+    return v * 0x010101
+
+# Per-frame geometry buffer. Voices draw into this instead of calling pylase
+# directly; colors are resolved against the local color stack at record time,
+# so one buffer can be replayed into any number of outputs.
+# Primitives are (type, x0, y0, x1, y1, color, samples) tuples.
+class DisplayList(object):
+    def __init__(self):
+        self.prims = []
+        self.color = 0xffffff
+        self.stack = []
+
+    def clear(self):
+        del self.prims[:]
+        self.color = 0xffffff
+        self.stack = []
+
+    def pushColor(self):
+        self.stack.append(self.color)
+
+    def popColor(self):
+        self.color = self.stack.pop()
+
+    def multColor(self, color):
+        self.color = colormul(self.color, color)
+
+    def line(self, p1, p2, color):
+        self.prims.append((PRIM_LINE, p1[0], p1[1], p2[0], p2[1],
+                           colormul(self.color, color), 0))
+
+    def dot(self, p, samples, color):
+        self.prims.append((PRIM_DOT, p[0], p[1], p[0], p[1],
+                           colormul(self.color, color), samples))
+
+    def replay(self, out, a=1, b=0):
+        # Output transforms only ever scale/offset X (x' = a * x + b)
+        if a == 1 and b == 0:
+            out.extend(self.prims)
+            return
+        out.extend((t, a * x0 + b, y0, a * x1 + b, y1, c, n)
+                   for t, x0, y0, x1, y1, c, n in self.prims)
@@ -0,0 +1,36 @@
+import threading, collections
+
+from operator import itemgetter
+
+# Multi-producer event queue built from one single-producer/single-consumer
+# deque per producer thread. deque.append() and popleft() are atomic, so the
+# hot path takes no lock; the lock only serializes registering a new producer
+# thread, and the queue table is replaced copy-on-write so the consumer can
+# walk it without locking either.
+# Events are tuples whose first element is a timestamp; when several producers
+# have pending events they are merged in timestamp order.
+class EventQueue(object):
+    def __init__(self):
+        self.queues = ()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def put(self, ev):
+        q = getattr(self.local, "q", None)
+        if q is None:
+            q = self.local.q = collections.deque()
+            with self.lock:
+                self.queues = self.queues + (q,)
+        q.append(ev)
+
+    def drain(self):
+        events = []
+        busy = 0
+        for q in self.queues:
+            if q:
+                busy += 1
+                while q:
+                    events.append(q.popleft())
+        if busy > 1:
+            events.sort(key=itemgetter(0))
+        return events
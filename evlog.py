@@ -0,0 +1,145 @@
+import sys, os, threading, itertools, signal, time
+
+DEBUG = 10
+INFO = 20
+WARN = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: "debug", INFO: "info", WARN: "warn", ERROR: "error"}
+LEVELS = {v: k for k, v in LEVEL_NAMES.items()}
+
+# In-memory event log. Records are (seq, t, subsystem, level, fmt, args)
+# tuples written into a fixed ring; the hot path only does a level check, a
+# counter increment and one list store, and never formats or touches I/O.
+# Formatting happens in the flusher thread (records at or above
+# flush_level go to the output stream) or in dump(), which writes out
+# everything still in the ring. Mutable args are formatted late, so callers
+# should pass copies of anything they keep changing.
+class EventLog(object):
+    def __init__(self, size=16384, level=DEBUG, flush_level=INFO):
+        self.size = size
+        self.buf = [None] * size
+        self.seq = itertools.count()
+        self.head = 0
+        self.level = level
+        self.levels = {}
+        self.flush_level = flush_level
+        self.flushed = 0
+        self.dropped = 0
+        self.out = sys.stderr
+        self.thread = None
+        self.dump_requested = False
+        self.active = True
+
+    def set_level(self, subsys, level):
+        if isinstance(level, str):
+            level = LEVELS[level]
+        self.levels[subsys] = level
+
+    # LVJ_LOG syntax: "info,midi=debug,flush=warn" sets the default capture
+    # level, per-subsystem capture levels and the console level
+    def configure(self, spec):
+        for item in spec.split(","):
+            item = item.strip()
+            if "=" in item:
+                subsys, level = item.split("=")
+                if subsys.strip() == "flush":
+                    self.flush_level = LEVELS[level.strip()]
+                else:
+                    self.set_level(subsys.strip(), level.strip())
+            elif item:
+                self.level = LEVELS[item]
+
+    def enabled(self, subsys, level):
+        return level >= self.levels.get(subsys, self.level)
+
+    def log(self, subsys, level, fmt, *args):
+        if level < self.levels.get(subsys, self.level):
+            return
+        i = next(self.seq)
+        self.buf[i % self.size] = (i, time.monotonic_ns() * 1e-9, subsys, level, fmt, args)
+        self.head = i + 1
+
+    def debug(self, subsys, fmt, *args):
+        self.log(subsys, DEBUG, fmt, *args)
+
+    def info(self, subsys, fmt, *args):
+        self.log(subsys, INFO, fmt, *args)
+
+    def warn(self, subsys, fmt, *args):
+        self.log(subsys, WARN, fmt, *args)
+
+    def error(self, subsys, fmt, *args):
+        self.log(subsys, ERROR, fmt, *args)
+
+    @staticmethod
+    def format(rec):
+        i, t, subsys, level, fmt, args = rec
+        try:
+            msg = fmt % args if args else fmt
+        except Exception as e:
+            msg = "%s %r (%s)" % (fmt, args, e)
+        return "%12.6f %-5s %-6s %s" % (t, LEVEL_NAMES.get(level, level), subsys, msg)
+
+    # Records with sequence numbers in [start, end) still in the ring
+    def records(self, start, end):
+        start = max(start, end - self.size)
+        recs = []
+        for i in range(start, end):
+            rec = self.buf[i % self.size]
+            # Skip slots not yet written or already overwritten by a newer record
+            if rec is not None and rec[0] == i:
+                recs.append(rec)
+        return recs
+
+    def flush(self):
+        end = self.head
+        if end - self.flushed > self.size:
+            self.dropped += end - self.size - self.flushed
+            self.out.write("evlog: %d records overwritten before flush\n" % (end - self.size - self.flushed))
+        for rec in self.records(self.flushed, end):
+            if rec[3] >= self.flush_level:
+                self.out.write(self.format(rec) + "\n")
+        self.flushed = end
+        self.out.flush()
+
+    def dump(self, out=None, last=None):
+        out = out or self.out
+        end = self.head
+        start = end - (last or self.size)
+        out.write("---- evlog dump ----\n")
+        for rec in self.records(start, end):
+            out.write(self.format(rec) + "\n")
+        out.write("---- end ----\n")
+        out.flush()
+
+    def run(self, interval):
+        while self.active:
+            time.sleep(interval)
+            self.flush()
+            if self.dump_requested:
+                self.dump_requested = False
+                self.dump()
+
+    def start(self, interval=0.2):
+        self.thread = threading.Thread(target=self.run, args=(interval,), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.active = False
+        if self.thread:
+            self.thread.join()
+        self.flush()
+
+    # kill -USR1 <pid> dumps the whole ring from the flusher thread
+    def install_signal(self, signum=signal.SIGUSR1):
+        def handler(sig, frame):
+            self.dump_requested = True
+        signal.signal(signum, handler)
+
+log = EventLog()
+# Channel state dumps deep-copy the whole state on every slider tick; only
+# with LVJ_LOG=state=debug
+log.set_level("state", INFO)
+if os.environ.get("LVJ_LOG"):
+    log.configure(os.environ["LVJ_LOG"])
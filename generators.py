@@ -20,7 +20,13 @@ class Gen(object):
     def deselect(self):
         pass
 
-    def clock(self, tick, period):
+    # t is the exact time tick is due (it may still be in the future);
+    # pass it on as noteon(at=t) so onsets land on the beat grid
+    def clock(self, tick, period, t=None):
+        pass
+
+    # Called on the GUI thread after a gen.* parameter changed
+    def params_changed(self):
         pass
 
 class GenPattern(Gen):
@@ -40,6 +46,38 @@ class GenPattern(Gen):
                             ch.setActive(False)
                 self.parent.setActive(True)
 
+# Pattern generator driven by a trigger table compiled from its parameters:
+# compile_pattern() returns (loop, {tick: events}) for tick in [0, loop),
+# and clock() does one lookup per tick and hands the events to fire().
+# Default events are (l, r, vel, ticks) note-ons lasting ticks clock periods.
+# The table is rebuilt by params_changed() and swapped in as one tuple, so
+# the clock thread never sees a half-built pattern.
+class GenTable(GenPattern):
+    def __init__(self, parent, state):
+        super().__init__(parent, state)
+        self.params_changed()
+
+    @property
+    def loop(self):
+        return int(24 * 4 * 2**self.parent.state["gen"].get("timebase", 0))
+
+    def compile_pattern(self):
+        return 1, {}
+
+    def params_changed(self):
+        self.pattern = self.compile_pattern()
+
+    def clock(self, tick, period, t=None):
+        loop, table = self.pattern
+        events = table.get(tick % loop)
+        if events:
+            self.fire(events, period, t)
+
+    def fire(self, events, period, t):
+        noteon = self.parent.synth.noteon
+        for l, r, vel, ticks in events:
+            noteon(l, r, vel, period * ticks, at=t)
+
 class GenKey(Gen):
     NAME = "Key"
     CONFLICTS = ("key", "left", "right")
@@ -59,7 +97,7 @@ class GenKey(Gen):
 
     def ctl_key(self, state, start, end, vel, **kw):
         if state:
-            self.parent.synth.noteon(start, end, vel)
+            self.parent.synth.noteon(start, end, vel, stamp=kw.get("stamp"))
         else:
             self.parent.synth.noteoff(start, end, vel)
 
@@ -83,9 +121,9 @@ class GenOneShot(Gen):
         elif self.pstart is not None:
             self.parent.synth.noteoff(self.pstart, self.pend, vel)
 
-    def ctl_key(self, state, start, end, vel):
+    def ctl_key(self, state, start, end, vel, **kw):
         if state:
-            self.parent.synth.noteon(start, end, vel)
+            self.parent.synth.noteon(start, end, vel, stamp=kw.get("stamp"))
         else:
             self.parent.synth.noteoff(start, end, vel)
 
@@ -95,7 +133,7 @@ class GenKeyRight(GenKey):
 
     def ctl_key(self, state, start, end, vel, **kw):
         if kw.get("area", None) == "right":
-            super().ctl_key(state, start, end, vel)
+            super().ctl_key(state, start, end, vel, **kw)
 
 class GenKeyLeft(GenKey):
     NAME = "Key Left"
@@ -103,9 +141,10 @@ class GenKeyLeft(GenKey):
 
     def ctl_key(self, state, start, end, vel, **kw):
         if kw.get("area", None) == "left":
-            super().ctl_key(state, start, end, vel)
+            super().ctl_key(state, start, end, vel, **kw)
 
-class GenSubdivided(GenPattern):
+# Splits the loop into width slots, each starting at tick i * loop // width
+class GenSubdivided(GenTable):
     @property
     def width(self):
         return max(1, int(self.parent.state["gen"].get("param", 0) / 126 * 32))
@@ -113,34 +152,30 @@ class GenSubdivided(GenPattern):
     @property
     def statusText(self):
         return "W: %d" % self.width
-    
-    def clock(self, tick, period):
-        loop = int(24 * 4 * 2**self.parent.state["gen"].get("timebase", 0))
+
+    def compile_pattern(self):
+        loop = self.loop
         width = self.width
-        tick %= loop
-        a = width * tick // loop
-        b = width * (tick + 1) // loop
-        dur = period * loop / width
+        table = {}
         for i in range(width):
-            lp = i * loop // width
-            if lp == tick:
-                self.trigger(i, width, dur)
-
+            l, r = self.slot(i, width)
+            table.setdefault(i * loop // width, []).append((l, r, 127, loop / width))
+        return loop, table
 
 class GenSweepRight(GenSubdivided):
     NAME = "Sweep R"
 
-    def trigger(self, pos, width, dur):
-        self.parent.synth.noteon(pos / width, (pos + 1) / width, 127, dur)
+    def slot(self, pos, width):
+        return pos / width, (pos + 1) / width
 
 class GenSweepLeft(GenSubdivided):
     NAME = "Sweep L"
 
-    def trigger(self, pos, width, dur):
+    def slot(self, pos, width):
         pos = width - pos - 1
-        self.parent.synth.noteon(pos / width, (pos + 1) / width, 127, dur)
+        return pos / width, (pos + 1) / width
 
-class GenRandom(GenPattern):
+class GenRandom(GenTable):
     NAME = "Random"
 
     @property
@@ -155,14 +190,15 @@ class GenRandom(GenPattern):
     def statusText(self):
         return "%d%% ×%d" % (100 * self.width, self.mult)
     
-    def clock(self, tick, period):
-        loop = int(24 * 4 * 2**self.parent.state["gen"].get("timebase", 0))
-        dur = period * loop
-        w = self.width
-        if tick % loop == 0:
-            for i in range(self.mult):
-                x = random.uniform(0, 1 - w)
-                self.parent.synth.noteon(x, x + w, 127, dur)
+    # One event per note at the loop start, placed at random when fired
+    def compile_pattern(self):
+        loop = self.loop
+        return loop, {0: [(self.width, 127, loop)] * self.mult}
+
+    def fire(self, events, period, t):
+        for w, vel, ticks in events:
+            x = random.uniform(0, 1 - w)
+            self.parent.synth.noteon(x, x + w, vel, period * ticks, at=t)
 
 GENS = OrderedDict(
     key=GenKey,
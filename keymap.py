@@ -0,0 +1,53 @@
+import json
+
+PAD_ACTIONS = ("mode", "incontrol", "alt", "selector", "cpick", "bpm_reset", "bpm_kick")
+
+# Controller layout compiled from a keymap file (see keymap.json). Port names
+# are resolved to port numbers once, so note dispatch is one dict lookup:
+#   keys[(port, ch, note)] -> ((start, end, area), ...)
+#   pads[(port, ch, note)] -> (slot, color, action)
+# A section with "channel": null matches every MIDI channel. slot_note,
+# color_note and action_note map back to the pad notes for LED feedback.
+class KeyMap(object):
+    def __init__(self, data, ports):
+        self.name = data.get("name", "")
+        self.keys = {}
+        self.pads = {}
+        self.slot_note = {}
+        self.color_note = {}
+        self.action_note = {}
+
+        def addrs(section, note):
+            port = ports[section["port"]]
+            ch = section.get("channel")
+            chans = range(16) if ch is None else (ch,)
+            return [(port, c, note) for c in chans]
+
+        section = data.get("keys")
+        if section:
+            for e in section["map"]:
+                spans = tuple((float(a), float(b), area) for a, b, area in e["spans"])
+                for addr in addrs(section, e["note"]):
+                    self.keys[addr] = spans
+
+        section = data.get("pads")
+        if section:
+            for e in section["map"]:
+                action = e.get("action")
+                if action is not None and action not in PAD_ACTIONS:
+                    raise ValueError("unknown pad action %r" % action)
+                pad = (e.get("slot"), e.get("color"), action)
+                for addr in addrs(section, e["note"]):
+                    self.pads[addr] = pad
+                for table, key in ((self.slot_note, pad[0]), (self.color_note, pad[1]),
+                                   (self.action_note, action)):
+                    if key is not None:
+                        table[key] = e["note"]
+
+        leds = data.get("leds", {})
+        self.led_port = ports[leds["port"]] if "port" in leds else None
+        self.led_channel = leds.get("channel", 0)
+
+def load_keymap(path, ports):
+    with open(path) as fd:
+        return KeyMap(json.load(fd), ports)
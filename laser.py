@@ -1,16 +1,56 @@
 import threading, os, traceback, math, time
 
-import pylase as ol
+import numpy as np
+
+from backend import get_backend
+from displaylist import DisplayList, PRIM_LINE
+from stats import RenderStats, LatencyStats
+from optimize import merge_intervals, blank_moves, reorder
+from voices import DEGRADE_ORDER
+from util import ftime
+from colors import Calibration
+from bpm import mono
+
+NUM_OUTPUTS = 2
+
+# Channel output mode -> (output, a, b) for each output it draws on, with the
+# output transform x' = a * x + b
+OUTPUT_MAPS = {
+    "span": ((0, 2, 0), (1, 2, -1)),
+    "clone": ((0, 1, 0), (1, 1, 0)),
+    "mirror": ((0, 1, 0), (1, -1, 1)),
+    "left": ((0, 1, 0),),
+    "right": ((1, 1, 0),),
+}
 
 class Renderer(threading.Thread):
-    def __init__(self, parent):
+    def __init__(self, parent, backend=None):
         self.parent = parent
         super().__init__()
+        self.ol = backend if backend is not None else get_backend()
         self.active = True
-        self.bright = 255
+        # Per-output color calibration; master brightness is folded into
+        # the same lookup tables
+        self.calibration = [Calibration() for i in range(NUM_OUTPUTS)]
+        self._bright = 255
         self.busy_scenes = {}
+        self.dl = DisplayList()
+        self.frame = [[] for i in range(NUM_OUTPUTS)]
+        self.stats = RenderStats()
+        # Input stamps of voices drawn for the first time this frame
+        self.stamps = []
+        self.latency = LatencyStats()
+        # Max primitives per output per frame (None = unlimited)
+        self.budget = None
+        self.degrade = DEGRADE_ORDER
+        self.limits = {}
+        # Frame-level optimization passes
+        self.merge = False
+        # Path ordering strategy, see optimize.reorder()
+        self.reorder = "none"
 
-    def main(self):
+    def setup(self):
+        ol = self.ol
         params = ol.RenderParams()
         params.render_flags = ol.RENDER_NOREORDER
         params.on_speed = 2/100.0
@@ -22,21 +62,39 @@ class Renderer(threading.Thread):
         params.curve_dwell = 0
         params.curve_angle = math.cos(30.0 * (math.pi / 180.0))
         params.snap = 0.0001
-        ol.init(2, num_outputs=2)
+        ol.init(2, num_outputs=NUM_OUTPUTS)
         ol.setRenderParams(params)
         ol.setScissor((-0.951, -0.951), (0.951, 0.951))
+
+    def render_frame(self):
+        ol = self.ol
+        ol.loadIdentity()
+        ol.scale((0.95, 0.95))
+        ol.translate((-1, 0))
+        ol.scale((2, 1))
+        ol.resetColor()
+        start = mono()
+        t0 = time.perf_counter()
+        voices = self.render()
+        t1 = time.perf_counter()
+        built = mono()
+        #ol.line((0,0.8), (1,0.8), ol.C_WHITE)
+        ret = ol.renderFrame(100)
+        self.stats.add_frame(t1 - t0, time.perf_counter() - t1, voices,
+                             sum(len(prims) for prims in self.frame))
+        if self.stamps:
+            done = mono()
+            for stamp in self.stamps:
+                self.latency.add(stamp, start, built, done)
+            del self.stamps[:]
+        return ret
+
+    def main(self):
+        self.setup()
         while self.active:
-            ol.loadIdentity()
-            ol.scale((0.95, 0.95))
-            ol.translate((-1, 0))
-            ol.scale((2, 1))
-            ol.resetColor()
-            ol.multColor(self.bright * 0x010101)
-            self.render()
-            #ol.line((0,0.8), (1,0.8), ol.C_WHITE)
-            ol.renderFrame(100)
-
-        ol.shutdown()
+            self.render_frame()
+
+        self.ol.shutdown()
 
     def run(self):
         try:
@@ -46,54 +104,133 @@ class Renderer(threading.Thread):
             os.abort()
 
     def render(self):
+        for prims in self.frame:
+            del prims[:]
+        # One timestamp for the whole frame, shared by every scene and voice
+        t = ftime()
         cursc = self.parent.cur_scene
-        voices = self.render_scene(cursc)
+        scenes = [cursc] + [sc for sc in self.busy_scenes if sc is not cursc]
+        for sc in scenes:
+            for ch in sc.channels:
+                ch.synth.apply_events(t)
+        if self.budget is not None:
+            self.plan_budget(scenes)
+        elif self.limits:
+            self.limits = {}
+        voices = self.render_scene(cursc, t)
+        total_voices = voices
         if voices > 0:
-            self.busy_scenes[cursc] = time.time()
-        for sc, t in list(self.busy_scenes.items()):
+            self.busy_scenes[cursc] = t
+        for sc, last in list(self.busy_scenes.items()):
             if sc is not cursc:
-                voices = self.render_scene(sc)
+                voices = self.render_scene(sc, t)
+                total_voices += voices
                 if voices > 0:
-                    self.busy_scenes[sc] = time.time()
-                elif time.time() > (1 + t):
+                    self.busy_scenes[sc] = t
+                elif t > (1 + last):
                     del self.busy_scenes[sc]
+        if self.merge:
+            self.merge_frame()
+        if self.reorder != "none":
+            self.reorder_frame()
+        self.submit()
+        return total_voices
 
-    def render_scene(self, scene):
+    def merge_frame(self):
+        saved_prims = saved_blanks = 0
+        for prims in self.frame:
+            if not prims:
+                continue
+            count, blanks = len(prims), blank_moves(prims)
+            prims[:] = merge_intervals(prims)
+            saved_prims += count - len(prims)
+            saved_blanks += blanks - blank_moves(prims)
+        self.stats.add("merge saved prims", saved_prims)
+        self.stats.add("merge saved blanks", saved_blanks)
+
+    def reorder_frame(self):
+        saved = 0.0
+        t0 = time.perf_counter()
+        for prims in self.frame:
+            if not prims:
+                continue
+            prims[:], before, after = reorder(prims, self.reorder)
+            saved += before - after
+        self.stats.add("reorder saved travel", saved)
+        self.stats.add("reorder time", time.perf_counter() - t0)
+
+    def plan_budget(self, scenes):
+        # Scale down every channel drawing on an output whose projected cost
+        # exceeds the budget, proportionally to its own cost
+        load = [0] * NUM_OUTPUTS
+        costs = []
+        for sc in scenes:
+            for ch in sc.channels:
+                cost = ch.synth.cost()
+                if not cost:
+                    continue
+                outputs = [i[0] for i in OUTPUT_MAPS.get(ch.state["map"], ())]
+                for output in outputs:
+                    load[output] += cost
+                costs.append((ch, cost, outputs))
+        self.limits = {}
+        for ch, cost, outputs in costs:
+            scale = min([self.budget / load[o] for o in outputs] + [1])
+            if scale < 1:
+                self.limits[ch] = int(cost * scale)
+
+    def render_scene(self, scene, t):
         total_voices = 0
+        dl = self.dl
+        perf = time.perf_counter
         for ch in scene.channels:
-            mode = ch.state["map"]
-            if mode == "span":
-                ol.setOutput(0)
-                ol.pushMatrix()
-                ol.scale((2, 1))
-                voices = ch.synth.render()
-                ol.popMatrix()
-
-                ol.setOutput(1)
-                ol.pushMatrix()
-                ol.translate((-1, 0))
-                ol.scale((2, 1))
-                ch.synth.render()
-                ol.popMatrix()
-            if mode == "clone":
-                ol.setOutput(0)
-                voices = ch.synth.render()
-                ol.setOutput(1)
-                ch.synth.render()
-            elif mode == "mirror":
-                ol.setOutput(0)
-                voices = ch.synth.render()
-                ol.setOutput(1)
-                ol.pushMatrix()
-                ol.translate((1, 0))
-                ol.scale((-1, 1))
-                ch.synth.render()
-                ol.popMatrix()
-            if mode == "left":
-                ol.setOutput(0)
-                voices = ch.synth.render()
-            if mode == "right":
-                ol.setOutput(1)
-                voices = ch.synth.render()
+            t0 = perf()
+            dl.clear()
+            voices = ch.synth.render(dl, t, self.limits.get(ch), self.degrade)
+            if ch.synth.stamps:
+                self.stamps.extend(ch.synth.stamps)
+                del ch.synth.stamps[:]
+            if not voices:
+                continue
             total_voices += voices
+            for output, a, b in OUTPUT_MAPS.get(ch.state["map"], ()):
+                dl.replay(self.frame[output], a, b)
+            self.stats.add_channel(ch.chid, ch.state["voice"].get("type", "bar"), perf() - t0,
+                                   voices, len(dl.prims))
         return total_voices
+
+    def get_stats(self):
+        return self.stats.summary()
+
+    @property
+    def bright(self):
+        return self._bright
+
+    @bright.setter
+    def bright(self, bright):
+        self._bright = bright
+        for cal in self.calibration:
+            cal.set_bright(bright)
+
+    def set_calibration(self, output, cal):
+        cal.set_bright(self._bright)
+        self.calibration[output] = cal
+
+    def submit(self):
+        ol = self.ol
+        for output, prims in enumerate(self.frame):
+            ol.setOutput(output)
+            if not prims:
+                continue
+            cal = self.calibration[output]
+            identity, luts = cal.tables
+            if identity:
+                colors = [p[5] for p in prims]
+            else:
+                colors = cal.apply(np.fromiter((p[5] for p in prims), np.uint32,
+                                               len(prims)), luts).tolist()
+            for (t, x0, y0, x1, y1, c, samples), color in zip(prims, colors):
+                if t == PRIM_LINE:
+                    ol.line((x0, y0), (x1, y1), color)
+                else:
+                    ol.dot((x0, y0), samples, color)
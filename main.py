@@ -1,26 +1,31 @@
 #!/usr/bin/python3
 # -!- coding: utf-8 -!-
 import sys, os, subprocess, time, atexit, urllib, base64, json, copy
-from pprint import pprint
 from collections import OrderedDict
 from functools import partial
 
 from PyQt5 import QtWidgets, uic
-from PyQt5.QtCore import Qt, QSettings, QCoreApplication, QAbstractListModel, QModelIndex, QItemSelectionModel
-from PyQt5.QtGui import QPalette, QColor
+from PyQt5.QtCore import Qt, QSettings, QCoreApplication, QAbstractListModel, QModelIndex, QItemSelectionModel, pyqtSignal
+from PyQt5.QtGui import QPalette, QColor, QKeySequence
 from PyQt5.QtWidgets import (QApplication, QMainWindow,
         QWidget, QToolButton, QGroupBox, QGridLayout, QTabWidget,
         QVBoxLayout, QHBoxLayout, QSizePolicy, QLabel, QSpacerItem,
-        QComboBox, QFrame, QFileDialog, QListWidgetItem, QAbstractItemView)
+        QComboBox, QFrame, QFileDialog, QListWidgetItem, QAbstractItemView, QShortcut)
 
 from generators import GENS
-from voices import BasicSynth, VOICES
+from voices import VOICES, BasicSynth
+from voicepool import PooledSynth
 from controller import LaunchKeyController
 
-from util import ADSR
+from util import ADSR, from_mono
 from colors import PALETTE
 from laser import Renderer
 from bpm import BPMThread
+from dispatch import TickDispatcher
+from beat import BeatThread
+from midirec import MIDIRecorder
+from osc import OSCServer, OSCControl
+from evlog import log, DEBUG
 from util import gamma
 
 DEFAULT_STATE = {
@@ -47,6 +52,14 @@ DEFAULT_STATE = {
     "color": 0,
 }
 
+# Per-voice objects are faster for the usual few dozen voices per channel;
+# LVJ_SYNTH=pool selects the vectorized voice pool for very dense scenes
+SYNTHS = {
+    "object": BasicSynth,
+    "pool": PooledSynth,
+}
+SYNTH = SYNTHS[os.environ.get("LVJ_SYNTH", "object")]
+
 OUTPUT_MODES = [
     "span",
     "clone",
@@ -129,7 +142,7 @@ class Channel(QFrame):
         self.cb_color.clearFocus()
         self.synth.color = gamma(PALETTE[self.state["color"]])
         self.stateChanged()
-        self._parent._parent.controller.update_leds()
+        self._parent._parent.controller.request_leds()
 
     def sliderMoved(self, param, value):
         s = self.state
@@ -142,6 +155,7 @@ class Channel(QFrame):
         if param.startswith("voice.env."):
             self.synth.adsr = ADSR(self.state["voice"]["env"])
         if param.startswith("gen."):
+            self.gen.params_changed()
             self.updateStatus()
 
     def mousePressEvent(self, ev):
@@ -160,14 +174,14 @@ class Channel(QFrame):
         if not active:
             self.synth.alloff()
         #self.stateChanged()
-        self._parent._parent.controller.update_leds()
+        self._parent._parent.controller.request_leds()
 
     def activeChanged(self):
         active = self.state["active"] = self.pb_active.isChecked()
         if not active:
             self.synth.alloff()
         #self.stateChanged()
-        self._parent._parent.controller.update_leds()
+        self._parent._parent.controller.request_leds()
 
     def stickyChanged(self):
         self.state["sticky"] = self.ck_sticky.isChecked()
@@ -176,7 +190,7 @@ class Channel(QFrame):
         self.gen = GENS[self.state["gen"]["type"]](self, self.state["gen"])
         voice = VOICES[self.state["voice"].get("type", "bar")]
         adsr = ADSR(self.state["voice"]["env"])
-        self.synth = BasicSynth(self, voice, adsr)
+        self.synth = SYNTH(self, voice, adsr)
         self.updateStatus()
         for i in "adsr":
             slider = getattr(self, "env_%s"%i)
@@ -188,11 +202,11 @@ class Channel(QFrame):
         self.mult.setValue(self.state["voice"].get("mult", 127))
 
     def stateChanged(self):
-        print("== %d ==" % self.chid)
-        pprint(self.state)
+        if log.enabled("state", DEBUG):
+            log.debug("state", "ch %d %r", self.chid, copy.deepcopy(self.state))
 
     def load(self, state):
-        print("LOAD", state)
+        log.info("ui", "LOAD %r", state)
         self.state = copy.deepcopy(DEFAULT_STATE)
         self.state.update(copy.deepcopy(state))
         self.stateChanged()
@@ -299,10 +313,10 @@ class Scene(QWidget):
         for i in self.channels:
             i.gen.deselect()
 
-    def clock(self, tick, period):
+    def clock(self, tick, period, t=None):
         for i in self.channels:
             if i.state["active"]:
-                i.gen.clock(tick, period)
+                i.gen.clock(tick, period, t)
 
 class SceneListModel(QAbstractListModel):
     def __init__(self, listobj, parent=None, *args):
@@ -331,7 +345,7 @@ class SceneListModel(QAbstractListModel):
         return Qt.MoveAction
 
     def setData(self, index, data, role=Qt.DisplayRole):
-        print("setData", index, data, role)
+        log.debug("ui", "setData %r %r %r", index, data, role)
         if role == Qt.EditRole:
             if not data.strip():
                 return False
@@ -350,7 +364,7 @@ class SceneListModel(QAbstractListModel):
             return False
 
     def insertRows(self, row, count, parent):
-        print("insertRows", row, count)
+        log.debug("ui", "insertRows %d %d", row, count)
         self.beginInsertRows(parent, row, (row + (count - 1)))
         new = []
         for i in range(count):
@@ -372,7 +386,7 @@ class SceneListModel(QAbstractListModel):
     def removeRows(self, row, count, parent):
         if self.rowCount() < 2:
             return False
-        print("removeRows", row, count)
+        log.debug("ui", "removeRows %d %d", row, count)
         try:
             self.beginRemoveRows(parent, row, row + count - 1)
             for i in self.l[row:row+count]:
@@ -385,7 +399,7 @@ class SceneListModel(QAbstractListModel):
             return False
 
     def moveRows(self, parent, sourceRow, count, destParent, destChild):
-        print("moveRows", sourceRow, conut, descChild)
+        log.debug("ui", "moveRows %d %d %d", sourceRow, count, destChild)
         return False
 
     def replaceList(self, scenes):
@@ -396,11 +410,21 @@ class SceneListModel(QAbstractListModel):
         self.endResetModel()
 
 class MainWindow(QMainWindow):
-    def __init__(self):
+    LOOKAHEAD = 2
+    # Emitted from the OSC server thread when it has queued input
+    oscPosted = pyqtSignal()
+
+    def __init__(self, seq=None, backend=None):
         super().__init__()
         uic.loadUi('mainwindow.ui', self)
 
-        self.controller = LaunchKeyController(self)
+        self.controller = LaunchKeyController(self, clock_out="LVJ_MIDI_CLOCK_OUT" in os.environ,
+                                              keymap=os.environ.get("LVJ_KEYMAP", "keymap.json"),
+                                              seq=seq)
+        # Capture all MIDI input for replay with midirec.py
+        record = os.environ.get("LVJ_MIDI_RECORD")
+        if record:
+            self.controller.recorder = MIDIRecorder(record)
         self.cur_scene = None
 
         self.scenes = [
@@ -423,16 +447,59 @@ class MainWindow(QMainWindow):
 
         self.b_sceneAdd.clicked.connect(self.sceneAdd)
         self.b_sceneDel.clicked.connect(self.sceneDel)
+
+        # Dump the event log ring to stderr (also: kill -USR1)
+        QShortcut(QKeySequence("Ctrl+Shift+L"), self).activated.connect(lambda: log.dump())
         
-        self.laser = Renderer(self)
+        self.laser = Renderer(self, backend)
         self.controller.update_leds()
         
-        self.bpm = BPMThread(self)
+        self.ticks = TickDispatcher()
+        self.ticks.add("leds", self.ledClock, coalesce=True)
+        self.ticks.add("gens", self.genClock)
+        if self.controller.clock_out:
+            self.ticks.add("midiclock", self.controller.send_clock, max_lag=2)
+        self.bpm = BPMThread(self.ticks)
         self.bpm.start()
 
-    def clock(self, tick, period):
+        # Read MIDI input on its own thread instead of the Qt loop; note
+        # triggers and tap tempo no longer wait for the GUI
+        if os.environ.get("LVJ_MIDI_THREAD"):
+            self.controller.start_input_thread()
+
+        # MIDI clock source as client:port; the "sync" port also accepts clock
+        # from any other subscription, stamped on arrival
+        clock_src = os.environ.get("LVJ_MIDI_CLOCK")
+        if clock_src:
+            client, port = clock_src.split(":")
+            self.controller.connect_stamped((int(client), int(port)), self.controller.sync)
+
+        # Audio beat tracking from raw s16le mono 44.1kHz PCM, e.g.
+        # arecord -f S16_LE -c 1 -r 44100 | LVJ_AUDIO=- ./main.py
+        audio = os.environ.get("LVJ_AUDIO")
+        if audio:
+            fd = sys.stdin.buffer if audio == "-" else open(audio, "rb")
+            self.beat = BeatThread(self.bpm, fd)
+            self.beat.start()
+
+        # OSC control over UDP, LVJ_OSC=[host:]port (see osc.py)
+        self.osc = None
+        osc_addr = os.environ.get("LVJ_OSC")
+        if osc_addr:
+            host, _, port = osc_addr.rpartition(":")
+            self.osc = OSCServer(self.oscPosted.emit, host or "127.0.0.1", int(port))
+            self.oscControl = OSCControl(self, self.osc)
+            self.oscPosted.connect(self.oscControl.apply)
+            self.osc.start()
+
+    def ledClock(self, tick, t, period):
         self.controller.clock(tick)
-        self.cur_scene.clock(tick, period)
+
+    # Generators run LOOKAHEAD ticks ahead of the clock and schedule their
+    # notes for the exact grid time of that tick, on the synth clock
+    def genClock(self, tick, t, period):
+        tick += self.LOOKAHEAD
+        self.cur_scene.clock(tick, period, from_mono(self.bpm.tick_time(tick)))
 
     def sceneSelectionChanged(self, current, previous):
         current = current.indexes()
@@ -441,6 +508,11 @@ class MainWindow(QMainWindow):
 
         self.setCurrentScene(current[0].row())
 
+    # Selects scene i through the scene list, so the list follows
+    def selectScene(self, i):
+        idx = self.sceneList.model().createIndex(i, 0)
+        self.sceneList.selectionModel().setCurrentIndex(idx, QItemSelectionModel.ClearAndSelect)
+
     def setCurrentScene(self, i):
         self.cur_scene.deselect()
         self.cur_scene.hide()
@@ -498,6 +570,8 @@ if __name__ == '__main__':
     QCoreApplication.setOrganizationDomain("marcan")
     QCoreApplication.setApplicationName("LVJ")
     app = QApplication(sys.argv)
+    log.start()
+    log.install_signal()
     window = MainWindow()
     window.laser.start()
     window.show()
@@ -514,4 +588,11 @@ if __name__ == '__main__':
     window.bpm.active = False
     window.laser.join()
     window.bpm.join()
+    window.controller.stop_input_thread()
+    if window.osc:
+        window.osc.stop()
+    window.ticks.stop()
+    if window.controller.recorder:
+        window.controller.recorder.close()
+    log.stop()
     sys.exit(rc)
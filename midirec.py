@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+# MIDI capture and replay. MIDIController.recorder writes every incoming
+# event to a compact file; the replay driver feeds a file (or a synthetic
+# set) back through a LaunchKeyController built on a FakeSequencer, with the
+# renderer on a null backend, and reports handling cost and throughput.
+import sys, os, struct, time, random, argparse
+
+from pyalsa.alsaseq import *
+
+from bpm import mono
+from stats import RingStats
+
+MAGIC = b"LVJMIDI1"
+# t (seconds from the first event), type, port, channel, note/param, value
+RECORD = struct.Struct("<dBBBBh")
+
+REC_NOTEON = 0
+REC_NOTEOFF = 1
+REC_CC = 2
+REC_PB = 3
+REC_CLOCK = 4
+REC_START = 5
+REC_CONTINUE = 6
+REC_STOP = 7
+
+REC_TYPES = {
+    SEQ_EVENT_NOTEON: REC_NOTEON,
+    SEQ_EVENT_NOTEOFF: REC_NOTEOFF,
+    SEQ_EVENT_CONTROLLER: REC_CC,
+    SEQ_EVENT_PITCHBEND: REC_PB,
+    SEQ_EVENT_CLOCK: REC_CLOCK,
+    SEQ_EVENT_START: REC_START,
+    SEQ_EVENT_CONTINUE: REC_CONTINUE,
+    SEQ_EVENT_STOP: REC_STOP,
+}
+SEQ_TYPES = {v: k for k, v in REC_TYPES.items()}
+REC_NAMES = ("noteon", "noteoff", "cc", "pb", "clock", "start", "continue", "stop")
+
+class MIDIRecorder(object):
+    def __init__(self, path):
+        self.fd = open(path, "wb")
+        self.fd.write(MAGIC)
+        self.t0 = None
+        self.count = 0
+
+    def add(self, ev_type, port, data, t):
+        rec = REC_TYPES.get(ev_type)
+        if rec is None:
+            return
+        if self.t0 is None:
+            self.t0 = t
+        if rec in (REC_NOTEON, REC_NOTEOFF):
+            ch, a, b = data["note.channel"], data["note.note"], data["note.velocity"]
+        elif rec == REC_CC:
+            ch, a, b = data["control.channel"], data["control.param"], data["control.value"]
+        elif rec == REC_PB:
+            ch, a, b = data["control.channel"], 0, data["control.value"]
+        else:
+            ch = a = b = 0
+        self.fd.write(RECORD.pack(t - self.t0, rec, port, ch, a, b))
+        self.count += 1
+
+    def close(self):
+        self.fd.close()
+
+def read_records(path):
+    with open(path, "rb") as fd:
+        if fd.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s: not a MIDI capture" % path)
+        data = fd.read()
+    n = len(data) // RECORD.size
+    return [RECORD.unpack_from(data, i * RECORD.size) for i in range(n)]
+
+def write_records(path, records):
+    with open(path, "wb") as fd:
+        fd.write(MAGIC)
+        for rec in records:
+            fd.write(RECORD.pack(*rec))
+
+# Stand-in for the pyalsa event objects MIDIController.poll() reads
+class FakeEvent(object):
+    def __init__(self, type, port, data, queue=None, time=0.0):
+        self.type = type
+        self.dest = (0, port)
+        self.data = data
+        self.queue = queue
+        self.timestamp = SEQ_TIME_STAMP_REAL
+        self.time = time
+
+    def get_data(self):
+        return self.data
+
+def make_event(rec, queue=None, time=0.0):
+    t, kind, port, ch, a, b = rec
+    if kind in (REC_NOTEON, REC_NOTEOFF):
+        data = {"note.channel": ch, "note.note": a, "note.velocity": b}
+    elif kind == REC_CC:
+        data = {"control.channel": ch, "control.param": a, "control.value": b}
+    elif kind == REC_PB:
+        data = {"control.channel": ch, "control.value": b}
+    else:
+        data = {}
+    return FakeEvent(SEQ_TYPES[kind], port, data, queue, time)
+
+# Enough of pyalsa's Sequencer for MIDIController: ports are numbered in
+# creation order like a fresh ALSA client, injected events come back from
+# receive_events(), and output events are counted instead of sent.
+class FakeSequencer(object):
+    def __init__(self, client_id=128):
+        self.client_id = client_id
+        self.ports = 0
+        self.queues = 0
+        self.inbox = []
+        self.output = []
+        self.drains = 0
+
+    def create_simple_port(self, name, type, caps=0):
+        port = self.ports
+        self.ports += 1
+        return port
+
+    def create_queue(self, name=None):
+        self.queues += 1
+        return self.queues - 1
+
+    def start_queue(self, queue):
+        pass
+
+    def register_poll(self, notifier):
+        pass
+
+    def connect_ports(self, *args):
+        pass
+
+    def inject(self, ev):
+        self.inbox.append(ev)
+
+    def receive_events(self, timeout=0, maxevents=100):
+        events = self.inbox[:maxevents]
+        del self.inbox[:maxevents]
+        return events
+
+    def output_event(self, ev):
+        self.output.append(ev)
+
+    def drain_output(self):
+        self.drains += 1
+
+# A busy set: 24 PPQ clock on the sync port, 16th-note keys with 32nd-note
+# gates, fader/knob sweeps on the control port at ~rate CCs per second and a
+# channel pad toggle every bar
+def synthetic_set(seconds, bpm=128, rate=200, seed=0, ports=(0, 1, 2)):
+    key, ctl, sync = ports
+    rng = random.Random(seed)
+    period = 60.0 / bpm
+    recs = [(0.0, REC_START, sync, 0, 0, 0)]
+    for i in range(int(seconds / period * 24)):
+        recs.append((i * period / 24, REC_CLOCK, sync, 0, 0, 0))
+    notes = list(range(48, 73))
+    for i in range(int(seconds / period * 4)):
+        t = i * period / 4
+        n = rng.choice(notes)
+        recs.append((t, REC_NOTEON, key, 0, n, rng.randint(40, 127)))
+        recs.append((t + period / 8, REC_NOTEOFF, key, 0, n, 0))
+    for i in range(int(seconds * rate)):
+        t = i / rate
+        param = 21 + (i // rate) % 8
+        recs.append((t, REC_CC, ctl, 15, param, int(63.5 + 63.5 * ((i % rate) / rate * 2 - 1))))
+    for i in range(int(seconds / period / 4)):
+        t = i * period * 4
+        pad = 96 + rng.randrange(7)
+        recs.append((t, REC_NOTEON, ctl, 15, pad, 127))
+        recs.append((t + 0.05, REC_NOTEOFF, ctl, 15, pad, 0))
+    recs.sort(key=lambda r: r[0])
+    return recs
+
+# Feeds records through window.controller in event-time order. Events due by
+# each step are injected and handled by one poll(), as one receive batch; a
+# frame is rendered inline every 1/fps. realtime paces steps on the wall
+# clock, otherwise virtual time advances as fast as the work allows.
+def replay(window, records, realtime=False, fps=100, render=True, process=None):
+    ctl = window.controller
+    seq = ctl.seq
+    renderer = window.laser
+    poll_cost = RingStats(1 << 16)
+    batch = RingStats(1 << 16)
+    step = 1.0 / fps
+    # Map capture time onto the controller's queue clock
+    start = mono()
+    offset = start - ctl.queue_t0
+    i = 0
+    frames = 0
+    vt = 0.0
+    end = records[-1][0] if records else 0
+    while vt <= end + step:
+        n = 0
+        while i < len(records) and records[i][0] <= vt:
+            seq.inject(make_event(records[i], ctl.queue, records[i][0] + offset))
+            i += 1
+            n += 1
+        if n:
+            t0 = time.perf_counter()
+            ctl.poll()
+            poll_cost.add(time.perf_counter() - t0)
+            batch.add(n)
+        if process:
+            process()
+        if render:
+            renderer.render_frame()
+            frames += 1
+        vt += step
+        if realtime:
+            delay = start + vt - mono()
+            if delay > 0:
+                time.sleep(delay)
+    wall = mono() - start
+    return {
+        "events": i,
+        "wall": wall,
+        "virtual": vt,
+        "frames": frames,
+        "poll": poll_cost.summary(),
+        "batch": batch.summary(),
+        "midi_out": len(seq.output),
+        "drains": seq.drains,
+        "cc_coalesced": ctl.cc_coalesced,
+    }
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Replay a MIDI capture through the controller")
+    parser.add_argument("input", nargs="?", help="capture file (default: synthetic set)")
+    parser.add_argument("--seconds", type=float, default=30, help="length of the synthetic set")
+    parser.add_argument("--rate", type=int, default=200, help="synthetic CCs per second")
+    parser.add_argument("--realtime", action="store_true")
+    parser.add_argument("--fps", type=int, default=100)
+    parser.add_argument("--no-render", action="store_true")
+    parser.add_argument("--save", help="write the synthetic set to a capture file")
+    parser.add_argument("--stats", action="store_true", help="dump render timing stats")
+    args = parser.parse_args(argv)
+
+    if args.input:
+        records = read_records(args.input)
+    else:
+        records = synthetic_set(args.seconds, rate=args.rate)
+        if args.save:
+            write_records(args.save, records)
+
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtWidgets import QApplication
+    from backend import get_backend
+    import main as lvj
+
+    app = QApplication(sys.argv[:1])
+    window = lvj.MainWindow(seq=FakeSequencer(), backend=get_backend("null"))
+    window.laser.setup()
+    try:
+        res = replay(window, records, args.realtime, args.fps, not args.no_render, app.processEvents)
+    finally:
+        window.bpm.active = False
+        window.bpm.join()
+        window.ticks.stop()
+
+    counts = [0] * len(REC_NAMES)
+    for rec in records:
+        counts[rec[1]] += 1
+    print("%d events (%s) over %.1fs in %.2fs wall, %.0f events/s" % (
+          res["events"], ", ".join("%s=%d" % (n, c) for n, c in zip(REC_NAMES, counts) if c),
+          res["virtual"], res["wall"], res["events"] / res["wall"]))
+    p, b = res["poll"], res["batch"]
+    if p:
+        print("poll: %d batches, events/batch p50 %d max %d, cost p50 %.1fus p99 %.1fus max %.1fus" % (
+              p["n"], b["p50"], b["max"], p["p50"] * 1e6, p["p99"] * 1e6, p["max"] * 1e6))
+    print("%d frames, %d MIDI out events, %d drains, %d CCs coalesced" % (
+          res["frames"], res["midi_out"], res["drains"], res["cc_coalesced"]))
+    if args.stats:
+        print(window.laser.stats.format())
+        print(window.laser.latency.format())
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,316 @@
+#!/usr/bin/python3
+# OSC over UDP control. The server runs an asyncio loop on its own thread,
+# parses and routes packets there, and hands the resulting actions to the Qt
+# thread in batches; OSCControl.apply() then runs them against the main
+# window. Addresses (N = channel slot, S = scene index):
+#   /lvj/ch/N/active  vel            pad press (vel 0 = release)
+#   /lvj/ch/N/fader   v              0..127, like the MIDI controls
+#   /lvj/ch/N/timebase v
+#   /lvj/ch/N/param/K v              K = 0, 1
+#   /lvj/ch/N/adsr/X  v              X = a, d, s, r
+#   /lvj/ch/N/color   c              palette index, clamped
+#   /lvj/key          start end vel [area]
+#                                    key on (vel 0 = off), start/end in 0..1,
+#                                    area "left"/"right" for the split gens
+#   /lvj/scene        S
+#   /lvj/bright       v
+#   /lvj/bpm/kick, /lvj/bpm/reset    tap tempo, timed on arrival
+# All messages of a bundle are applied in one batch; time tags are ignored.
+import sys, struct, asyncio, threading, argparse, socket, time
+
+from bpm import mono
+from evlog import log
+from colors import PALETTE
+
+class OSCError(Exception):
+    pass
+
+def read_string(data, pos):
+    end = data.index(b"\0", pos)
+    return data[pos:end].decode("utf-8", "replace"), (end + 4) & ~3
+
+ARG_TYPES = {
+    "i": (struct.Struct(">i"), 4),
+    "f": (struct.Struct(">f"), 4),
+    "h": (struct.Struct(">q"), 8),
+    "d": (struct.Struct(">d"), 8),
+}
+ARG_CONSTS = {"T": True, "F": False, "N": None, "I": float("inf")}
+
+def parse_message(data):
+    address, pos = read_string(data, 0)
+    if pos >= len(data):
+        return address, ()
+    tags, pos = read_string(data, pos)
+    if not tags.startswith(","):
+        raise OSCError("bad type tags %r" % tags)
+    args = []
+    for tag in tags[1:]:
+        if tag in ARG_TYPES:
+            fmt, size = ARG_TYPES[tag]
+            args.append(fmt.unpack_from(data, pos)[0])
+            pos += size
+        elif tag == "s":
+            s, pos = read_string(data, pos)
+            args.append(s)
+        elif tag == "b":
+            n = struct.unpack_from(">i", data, pos)[0]
+            args.append(data[pos + 4:pos + 4 + n])
+            pos = (pos + 4 + n + 3) & ~3
+        elif tag in ARG_CONSTS:
+            args.append(ARG_CONSTS[tag])
+        else:
+            raise OSCError("unsupported type tag %r" % tag)
+    return address, args
+
+# Flattens a packet (message or nested bundles) into [(address, args)]
+def parse_packet(data, out=None):
+    if out is None:
+        out = []
+    if data.startswith(b"#bundle\0"):
+        pos = 16
+        while pos + 4 <= len(data):
+            n = struct.unpack_from(">i", data, pos)[0]
+            parse_packet(data[pos + 4:pos + 4 + n], out)
+            pos += 4 + n
+    else:
+        out.append(parse_message(data))
+    return out
+
+def pad_string(s):
+    s = s.encode("utf-8") + b"\0"
+    return s + b"\0" * (-len(s) % 4)
+
+def build_message(address, *args):
+    tags = ","
+    payload = b""
+    for a in args:
+        if isinstance(a, float):
+            tags += "f"
+            payload += struct.pack(">f", a)
+        elif isinstance(a, int):
+            tags += "i"
+            payload += struct.pack(">i", a)
+        else:
+            tags += "s"
+            payload += pad_string(str(a))
+    return pad_string(address) + pad_string(tags) + payload
+
+def build_bundle(*messages):
+    return b"#bundle\0" + struct.pack(">Q", 1) + b"".join(
+        struct.pack(">i", len(m)) + m for m in messages)
+
+# Continuous controls: only the last value per target in a batch is applied
+CONTINUOUS = ("fader", "timebase", "param", "adsr", "bright")
+
+# Address -> (kind, target, args) with target identifying the control, or
+# None for unknown addresses
+def route(address, args, t):
+    parts = address.strip("/").split("/")
+    if not parts or parts[0] != "lvj":
+        return None
+    parts = parts[1:]
+    try:
+        if parts[0] == "ch":
+            ch, kind = int(parts[1]), parts[2]
+            if kind == "color":
+                return (kind, (kind, ch), (min(len(PALETTE) - 1, max(0, int(args[0]))),))
+            if kind in ("active", "fader", "timebase"):
+                return (kind, (kind, ch), (int(args[0]),))
+            if kind == "param":
+                return (kind, (kind, ch, int(parts[3])), (int(args[0]),))
+            if kind == "adsr" and parts[3] in ("a", "d", "s", "r"):
+                return (kind, (kind, ch, parts[3]), (int(args[0]),))
+        elif parts == ["key"]:
+            area = str(args[3]) if len(args) > 3 else None
+            return ("key", None, (float(args[0]), float(args[1]), int(args[2]), area, t))
+        elif parts == ["scene"]:
+            return ("scene", None, (int(args[0]),))
+        elif parts == ["bright"]:
+            return ("bright", ("bright",), (int(args[0]),))
+        elif parts[0] == "bpm" and parts[1:] in (["kick"], ["reset"]):
+            return (parts[1], None, (t,))
+    except (IndexError, ValueError, TypeError, OverflowError):
+        pass
+    return None
+
+class OSCProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        self.server.received(data, mono())
+
+# UDP server on its own thread. Routed packets are queued as batches (one
+# per packet, bundles kept whole); post() is called from the server thread
+# when the queue goes from empty to non-empty, and the consumer collects
+# everything queued so far with take(). While the Qt thread is busy, packets
+# pile up into one take() instead of one queued signal each.
+class OSCServer(threading.Thread):
+    RCVBUF = 1 << 20
+
+    def __init__(self, post, host="127.0.0.1", port=7700):
+        threading.Thread.__init__(self, name="osc", daemon=True)
+        self.post = post
+        self.host = host
+        self.port = port
+        self.loop = None
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        self.pending = []
+        self.posted = False
+        self.received_count = 0
+        self.errors = 0
+        self.unknown = 0
+
+    def received(self, data, t):
+        self.received_count += 1
+        try:
+            msgs = parse_packet(data)
+        except (OSCError, struct.error, ValueError) as e:
+            self.errors += 1
+            log.warn("osc", "bad packet: %s", e)
+            return
+        batch = []
+        for address, args in msgs:
+            action = route(address, args, t)
+            if action is None:
+                self.unknown += 1
+                log.debug("osc", "unhandled %s %r", address, args)
+            else:
+                batch.append(action)
+        if not batch:
+            return
+        with self.lock:
+            self.pending.append(batch)
+            if self.posted:
+                return
+            self.posted = True
+        self.post()
+
+    def take(self):
+        with self.lock:
+            batches, self.pending = self.pending, []
+            self.posted = False
+        return batches
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        transport, protocol = self.loop.run_until_complete(self.loop.create_datagram_endpoint(
+            lambda: OSCProtocol(self), local_addr=(self.host, self.port)))
+        sock = transport.get_extra_info("socket")
+        # Room for bursts while the loop is busy with a previous one
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RCVBUF)
+        self.port = sock.getsockname()[1]
+        self.ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            transport.close()
+            self.loop.close()
+
+    def stop(self):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join()
+
+# Applies routed actions to the main window; runs on the Qt thread
+class OSCControl(object):
+    def __init__(self, window, server):
+        self.window = window
+        self.server = server
+        self.applied = 0
+        self.coalesced = 0
+
+    def apply(self):
+        pending = {}
+        for batch in self.server.take():
+            for kind, target, args in batch:
+                if kind in CONTINUOUS:
+                    if target in pending:
+                        self.coalesced += 1
+                    pending[target] = (kind, args)
+                    continue
+                self.flush(pending)
+                self.run(kind, target, args)
+        self.flush(pending)
+
+    def flush(self, pending):
+        for target, (kind, args) in pending.items():
+            self.run(kind, target, args)
+        pending.clear()
+
+    def channel(self, n):
+        channels = self.window.cur_scene.channels
+        return channels[n] if 0 <= n < len(channels) else None
+
+    def run(self, kind, target, args):
+        w = self.window
+        self.applied += 1
+        if kind == "key":
+            start, end, vel, area, t = args
+            w.cur_scene.ctl_key(vel > 0, start, end, vel, area=area, stamp=t)
+        elif kind == "kick":
+            w.bpm.kick(args[0])
+        elif kind == "reset":
+            w.bpm.reset(args[0])
+        elif kind == "scene":
+            if 0 <= args[0] < len(w.scenes):
+                w.selectScene(args[0])
+        elif kind == "bright":
+            w.laser.bright = int(args[0] / 127 * 255)
+        else:
+            ch = self.channel(target[1])
+            if ch is None:
+                return
+            v = args[0]
+            if kind == "active":
+                ch.ctl_active(v > 0, v)
+            elif kind == "fader":
+                ch.ctl_fader(v)
+            elif kind == "timebase":
+                ch.ctl_timebase(v)
+            elif kind == "color":
+                ch.ctl_color(v)
+            elif kind == "param":
+                ch.ctl_param(target[2], v)
+            elif kind == "adsr":
+                ch.ctl_adsr(target[2], v)
+        w.controller.request_leds()
+
+# Loopback load test: counts what the server routes, no Qt involved
+def main(argv):
+    parser = argparse.ArgumentParser(description="OSC server loopback test")
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--rate", type=int, default=10000, help="messages per second")
+    parser.add_argument("--bundle", type=int, default=1, help="messages per bundle")
+    args = parser.parse_args(argv)
+
+    got = []
+    server = OSCServer(lambda: got.append(sum(len(b) for b in server.take())), port=0)
+    server.start()
+    server.ready.wait()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    msgs = [build_message("/lvj/ch/%d/fader" % (i % 8), i % 128) for i in range(args.bundle)]
+    packet = msgs[0] if args.bundle == 1 else build_bundle(*msgs)
+    packets = args.count // args.bundle
+    # Sent in 1ms bursts at the requested rate
+    burst = max(1, args.rate // args.bundle // 1000)
+    t0 = time.perf_counter()
+    for i in range(0, packets, burst):
+        for j in range(min(burst, packets - i)):
+            sock.sendto(packet, ("127.0.0.1", server.port))
+        delay = t0 + (i + burst) * args.bundle / args.rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    sent = time.perf_counter() - t0
+    deadline = time.perf_counter() + 1
+    while sum(got) < packets * args.bundle and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    server.stop()
+    print("%d/%d messages routed, sent over %.3fs (%.0f msg/s), %d posts, %d errors" % (
+          sum(got), packets * args.bundle, sent, packets * args.bundle / sent, len(got),
+          server.errors))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
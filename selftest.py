@@ -0,0 +1,436 @@
+#!/usr/bin/python3
+# Self-checks for refactored code paths, runnable without a DAC or MIDI
+# hardware: ./selftest.py [check ...] runs the named checks (default: all).
+import sys, random, argparse, threading, types
+
+import numpy as np
+
+from util import set_clock, OfflineClock, FakeClock, ADSR, gamma, from_mono
+from bpm import mono
+from voices import BasicSynth, VOICES
+from voicepool import PooledSynth
+from displaylist import DisplayList
+from laser import Renderer
+from colors import Calibration, PALETTE
+import osc
+from backend import get_backend
+from bench import BenchChannel, BenchScene, BenchParent
+
+# Budget limiting, segment merging and path reordering all active in the
+# same frames
+def check_passes():
+    set_clock(OfflineClock(100))
+    scene = BenchScene([BenchChannel(i, "pool", "bar", "span", 1) for i in range(14)])
+    renderer = Renderer(BenchParent(scene), get_backend("record"))
+    renderer.budget = 100
+    renderer.merge = True
+    renderer.reorder = "flip"
+    renderer.setup()
+    rng = random.Random(0)
+    limited = 0
+    for frame in range(50):
+        if frame % 25 == 0:
+            for ch in scene.channels:
+                for i in range(16):
+                    if rng.random() < 0.5:
+                        ch.synth.noteon(i / 16, (i + 1) / 16, 127, 0.25)
+        renderer.render_frame()
+        limited += bool(renderer.limits)
+    assert renderer.merge and renderer.reorder == "flip", "passes disabled by the budget"
+    extra = renderer.stats.summary()["extra"]
+    for key in ("merge saved prims", "reorder saved travel"):
+        assert extra.get(key) and extra[key]["n"] == 50, "%s not recorded every frame" % key
+    assert limited, "budget never limited a channel"
+    renderer.budget = None
+    renderer.render_frame()
+    assert not renderer.limits, "limits kept after the budget was lifted"
+
+# Brightness changes from another thread while the tables are in use
+def check_calibration():
+    cal = Calibration(gamma=(2.2, 2.0, 1.8))
+    colors = np.arange(0, 1 << 24, 4099, dtype=np.uint32)
+    errors = []
+    stop = []
+    def reader():
+        while not stop:
+            try:
+                identity, luts = cal.tables
+                cal.apply(colors, luts)
+            except Exception as e:
+                errors.append(e)
+    thread = threading.Thread(target=reader)
+    thread.start()
+    for i in range(3000):
+        cal.set_bright(i % 256)
+    stop.append(True)
+    thread.join()
+    assert not errors, "%d errors, first: %r" % (len(errors), errors[0])
+
+# OSC parsing and routing, including rejected addresses and clamping
+def check_osc():
+    packet = osc.build_bundle(osc.build_message("/lvj/key", 0.25, 0.5, 100, "right"),
+                              osc.build_bundle(osc.build_message("/lvj/ch/2/adsr/d", 5)),
+                              osc.build_message("/lvj/bpm/kick"))
+    routed = [osc.route(a, args, 1.0) for a, args in osc.parse_packet(packet)]
+    assert routed == [("key", None, (0.25, 0.5, 100, "right", 1.0)),
+                      ("adsr", ("adsr", 2, "d"), (5,)),
+                      ("kick", None, (1.0,))], routed
+    for address in ("/lvj/ch/0/adsr/sr", "/lvj/ch/0/adsr/ad", "/lvj/ch/0/adsr/x", "/x/y"):
+        assert osc.route(address, [5], 0) is None, address
+    assert osc.route("/lvj/ch/1/color", [99], 0)[2] == (len(PALETTE) - 1,)
+    assert osc.route("/lvj/ch/1/color", [-3], 0)[2] == (0,)
+    assert osc.route("/lvj/key", [0.1, 0.2, 0], 0)[2][3] is None
+    for v in (float("inf"), float("-inf"), float("nan")):
+        assert osc.route("/lvj/ch/0/fader", [v], 0) is None, v
+
+# ALLOFF cancels notes scheduled ahead before it, but not notes posted after
+# it (channel deactivated and re-activated while the gens run ahead), also
+# when the note comes from another thread (the gens worker)
+def live_voices(s):
+    if isinstance(s, PooledSynth):
+        return list(zip(s.pool.l[:s.pool.n].tolist(), s.pool.r[:s.pool.n].tolist()))
+    return list(s.voices.keys())
+
+def check_alloff():
+    for synth in ("object", "pool"):
+        clock = FakeClock(10.0)
+        set_clock(clock)
+        ch = BenchChannel(0, synth, "bar", "span", 1)
+        s = ch.synth
+        s.noteon(0.0, 0.5, 127, 1.0, at=10.030)
+        s.alloff()
+        clock.set(10.005)
+        s.noteon(0.5, 1.0, 127, 1.0, at=10.040)
+        s.apply_events(10.010)
+        s.apply_events(10.050)
+        live = live_voices(s)
+        assert live == [(0.5, 1.0)], "%s: %r" % (synth, live)
+
+        ch = BenchChannel(0, synth, "bar", "span", 1)
+        s = ch.synth
+        worker = threading.Thread(target=s.noteon, args=(0.0, 0.5, 127, 1.0), kwargs={"at": 10.030})
+        worker.start()
+        worker.join()
+        s.alloff()
+        s.apply_events(10.010)
+        s.apply_events(10.050)
+        live = live_voices(s)
+        assert live == [], "%s cross-thread: %r" % (synth, live)
+
+    # A tick scheduled 20ms ahead on the tempo clock lands 20ms ahead on a
+    # fake render clock
+    set_clock(FakeClock(10.0))
+    at = from_mono(mono() + 0.020)
+    assert abs(at - 10.020) < 0.005, at
+
+class SynthChannel(object):
+    def __init__(self, mult):
+        self.state = {"fader": 100, "voice": {"mult": mult}}
+
+def synth_frames(cls, voice, mult, limit, seed, frames=300):
+    clock = OfflineClock(100)
+    set_clock(clock)
+    rng = random.Random(seed)
+    env = {k: rng.choice([0, 10, 60, 127]) for k in "adsr"}
+    s = cls(SynthChannel(mult), VOICES[voice], ADSR(env))
+    s.color = gamma(0xff8000)
+    out = []
+    for f in range(frames):
+        if f % 7 == 0:
+            for i in range(rng.randint(0, 12)):
+                w = rng.choice([8, 10, 16])
+                p = rng.randrange(w)
+                s.noteon(p / w, (p + 1) / w, 127, rng.choice([None, 0.1, 0.5]))
+        if f % 11 == 0:
+            s.noteoff(0.5, 0.5 + 1 / 16, 0)
+        if f % 97 == 0:
+            s.alloff()
+        s.apply_events()
+        dl = DisplayList()
+        dl.multColor(0xc0c0c0)
+        n = s.render(dl, clock.frame(), limit)
+        out.append((n, dl.prims))
+    return out
+
+# PooledSynth draws the same primitives as the per-voice reference, for
+# every voice type, multiplier and budget, in the same left-to-right order
+def check_synths():
+    for voice in VOICES:
+        for mult in (1, 3):
+            for limit in (None, 40, 5):
+                for seed in range(4):
+                    a = synth_frames(BasicSynth, voice, mult, limit, seed)
+                    b = synth_frames(PooledSynth, voice, mult, limit, seed)
+                    for i, (x, y) in enumerate(zip(a, b)):
+                        assert x == y, "%s mult=%d limit=%s seed=%d: frame %d differs" % (
+                            voice, mult, limit, seed, i)
+    for n, prims in synth_frames(BasicSynth, "bar", 1, None, 0):
+        x = [p[1] for p in prims]
+        assert x == sorted(x), "voices not drawn left to right"
+
+# controller.py needs pyalsa and PyQt5. When they are missing, the checks
+# below run with minimal stand-ins for the names it imports so its event
+# handling can run on a midirec.FakeSequencer; nothing here talks to ALSA
+# or Qt. The stand-ins, and every module imported on top of them, are
+# removed again when the check returns.
+def with_controller(check):
+    def run():
+        modules = dict(sys.modules)
+        try:
+            import pyalsa.alsaseq, PyQt5.QtCore
+        except ImportError:
+            stub_controller_deps()
+        try:
+            import controller
+            check(controller)
+        finally:
+            for name in set(sys.modules) - set(modules):
+                del sys.modules[name]
+    return run
+
+def stub_controller_deps():
+    alsaseq = types.ModuleType("pyalsa.alsaseq")
+    names = ("SEQ_EVENT_NOTEON SEQ_EVENT_NOTEOFF SEQ_EVENT_CONTROLLER SEQ_EVENT_PITCHBEND "
+             "SEQ_EVENT_CLOCK SEQ_EVENT_START SEQ_EVENT_CONTINUE SEQ_EVENT_STOP "
+             "SEQ_TIME_STAMP_REAL SEQ_OPEN_DUPLEX SEQ_NONBLOCK SEQ_PORT_CAP_WRITE "
+             "SEQ_PORT_CAP_SUBS_WRITE SEQ_PORT_CAP_READ SEQ_PORT_CAP_SUBS_READ "
+             "SEQ_PORT_TYPE_MIDI_GENERIC SEQ_PORT_TYPE_APPLICATION").split()
+    for i, name in enumerate(names):
+        setattr(alsaseq, name, i + 1)
+    class SeqEvent(object):
+        def __init__(self, type):
+            self.type = type
+        def set_data(self, data):
+            self.data = data
+    alsaseq.SeqEvent = SeqEvent
+    alsaseq.__all__ = names + ["SeqEvent"]
+    pyalsa = types.ModuleType("pyalsa")
+    pyalsa.alsaseq = alsaseq
+    qtcore = types.ModuleType("PyQt5.QtCore")
+    qtcore.QObject = object
+    qtcore.QSocketNotifier = qtcore.QTimer = None
+    qtcore.pyqtSignal = lambda *args: None
+    sys.modules.update({"pyalsa": pyalsa, "pyalsa.alsaseq": alsaseq,
+                        "PyQt5": types.ModuleType("PyQt5"), "PyQt5.QtCore": qtcore})
+
+# Records everything a controller does to the rest of the app
+class CallLog(object):
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, *args):
+        self.calls.append(args)
+
+class LogChannel(object):
+    def __init__(self, log, i):
+        self.log = log
+        self.i = i
+        self.state = {"color": i % 16, "active": False}
+        self.focus = False
+
+    def ctl_active(self, state, v):
+        self.log("ctl_active", self.i, state, v)
+
+    def ctl_color(self, color):
+        self.log("ctl_color", self.i, color)
+
+class LogScene(object):
+    def __init__(self, log):
+        self.log = log
+        self.channels = [LogChannel(log, i) for i in range(14)]
+        self.cur_channel = self.channels[0]
+
+    def focusChannel(self, i):
+        self.log("focus", i)
+
+    def ctl_key(self, state, start, end, vel, area=None, **kw):
+        self.log("key", state, start, end, vel, area)
+
+class LogBPM(object):
+    def __init__(self, log):
+        self.log = log
+
+    def reset(self, t=None):
+        self.log("bpm_reset")
+
+    def kick(self, t=None):
+        self.log("bpm_kick")
+
+class LogParent(object):
+    def __init__(self):
+        self.log = CallLog()
+        self.cur_scene = LogScene(self.log)
+        self.bpm = LogBPM(self.log)
+
+def log_controller(controller):
+    from midirec import FakeSequencer
+    parent = LogParent()
+    ctl = controller.LaunchKeyController(parent, seq=FakeSequencer())
+    ctl.update_leds = lambda: parent.log("update_leds")
+    ctl.invalidate_leds = lambda: parent.log("invalidate_leds")
+    ctl.send_note = lambda *args: parent.log("send_note", *args)
+    return ctl, parent.log
+
+# The LaunchKey note handling before keymap.json, for check_keymap
+OLD_KEYS = {
+    48: [(0/10, 1/10, "left")], 50: [(1/10, 2/10, "left")], 52: [(2/10, 3/10, "left")],
+    53: [(3/10, 4/10, "left")], 55: [(4/10, 5/10, "left")],
+    49: [(0/10, 2.5/10, "left")], 51: [(2.5/10, 5/10, "left")],
+    57: [(5/10, 6/10, "left")], 59: [(6/10, 7/10, "left")], 60: [(7/10, 8/10, "left")],
+    62: [(8/10, 9/10, "left")], 64: [(9/10, 10/10, "left")],
+    61: [(5/10, 7.5/10, "left")], 63: [(7.5/10, 10/10, "left")],
+    54: [(0/10, 5/10, "left")], 56: [(0/10, 10/10, "left")], 58: [(5/10, 10/10, "left")],
+    65: [(4/10, 5/10, "right"), (5/10, 6/10, "right")],
+    67: [(3/10, 4/10, "right"), (6/10, 7/10, "right")],
+    69: [(2/10, 3/10, "right"), (7/10, 8/10, "right")],
+    71: [(1/10, 2/10, "right"), (8/10, 9/10, "right")],
+    72: [(0/10, 1/10, "right"), (9/10, 10/10, "right")],
+    66: [(2.5/10, 5/10, "right"), (5/10, 7.5/10, "right")],
+    68: [(0/10, 10/10, "right")],
+    70: [(0/10, 2.5/10, "right"), (7.5/10, 10/10, "right")],
+}
+
+def old_note_event(self, ST, port, ch, state, note, v):
+    cursc = self.parent.cur_scene
+    curch = cursc.cur_channel
+    if port == self.ctl and ch == 15:
+        if note == 13 and v == 0:
+            self.invalidate_leds()
+            self.update_leds()
+            return
+        if note == 15 and v == 0:
+            self.send_note(self.fb, 15, True, 15, 127)
+            self.send_note(self.fb, 15, True, 16, 127)
+            self.invalidate_leds()
+            self.update_leds()
+            return
+        if note == 120:
+            if state:
+                if self.cpick_state in (ST.ST_REL, ST.ST_OFF):
+                    self.cpick_state = ST.ST_HOLD
+                elif self.cpick_state in (ST.ST_HOLD, ST.ST_ACTIVE):
+                    self.cpick_state = ST.ST_OFF
+            else:
+                if self.cpick_state == ST.ST_HOLD:
+                    self.cpick_state = ST.ST_ACTIVE
+                elif self.cpick_state == ST.ST_REL:
+                    self.cpick_state = ST.ST_OFF
+            self.update_leds()
+            return
+        if note == 104:
+            self.selector = state
+            self.update_leds()
+        if note == 16:
+            self.alt = v > 0
+            return
+        if self.cpick_state == ST.ST_REL and not state and (96 <= note <= 103 or 112 <= note <= 119):
+            self.cpick_state = ST.ST_OFF
+            return
+        if self.cpick_state == ST.ST_OFF:
+            if 96 <= note <= 102 or 112 <= note <= 118:
+                slot = note - 96 if note <= 102 else note - 112 + 7
+                if self.alt or self.selector:
+                    cursc.focusChannel(slot)
+                    self.update_leds()
+                else:
+                    cursc.channels[slot].ctl_active(state, v)
+            if state and note == 103:
+                self.parent.bpm.reset()
+            if state and note == 119:
+                self.parent.bpm.kick()
+        elif self.cpick_state in (ST.ST_HOLD, ST.ST_ACTIVE) and state:
+            if 96 <= note <= 103 or 112 <= note <= 119:
+                color = note - 96 if note <= 103 else note - 112 + 8
+                if self.cpick_state == ST.ST_HOLD:
+                    self.cpick_state = ST.ST_REL
+                curch.ctl_color(color)
+                self.update_leds()
+        return
+    if port == self.key:
+        for start, end, area in OLD_KEYS.get(note, ()):
+            self.trigger_note(state, start, end, v, area=area)
+
+# keymap.json reproduces the old if/elif note handling: same key spans, and
+# the same calls and pad state machine transitions for a random stream of
+# key and pad events on every port and channel
+@with_controller
+def check_keymap(controller):
+    new, new_log = log_controller(controller)
+    old, old_log = log_controller(controller)
+    km = new.keymap
+    for ch in range(16):
+        for note in range(128):
+            spans = km.keys.get((new.key, ch, note), ())
+            assert [tuple(s) for s in spans] == OLD_KEYS.get(note, []), "key %d ch %d" % (note, ch)
+    rng = random.Random(0)
+    notes = list(range(0, 128))
+    pads = [13, 15, 16, 104, 120] + list(range(96, 104)) + list(range(112, 120))
+    for i in range(20000):
+        port = rng.choice((new.key, new.ctl, new.sync))
+        ch = rng.choice((0, 15, 15, 15, rng.randrange(16)))
+        note = rng.choice(pads + pads + notes) if port == new.ctl else rng.choice(notes)
+        state = rng.random() < 0.5
+        v = rng.choice((0, 64, 127)) if state else 0
+        new.note_event(port, ch, state, note, v)
+        old_note_event(old, controller, port, ch, state, note, v)
+        assert new_log.calls == old_log.calls, "event %d %r: %r != %r" % (
+            i, (port, ch, state, note, v), new_log.calls[-3:], old_log.calls[-3:])
+        st = lambda c: (c.cpick_state, c.alt, c.selector)
+        assert st(new) == st(old), "event %d: state %r != %r" % (i, st(new), st(old))
+
+# CC and pitch bend coalescing in MIDIController.poll: the last value per
+# control, flushed in first-seen order before any other event and at the
+# end of the batch; discrete CCs are delivered in place
+@with_controller
+def check_coalesce(controller):
+    from midirec import FakeSequencer, make_event, REC_NOTEON, REC_CC, REC_PB
+    delivered = []
+    class Recorder(controller.MIDIController):
+        def note_event(self, port, ch, state, note, v, t=None):
+            delivered.append(("note", note))
+        def ctl_event(self, port, ch, param, v):
+            delivered.append(("cc", param, v))
+        def pb_event(self, port, ch, v):
+            delivered.append(("pb", v))
+    ctl = Recorder(None, ["in"], [], seq=FakeSequencer())
+    ctl.discrete_ccs.add((0, 0, 64))
+    recs = [(REC_CC, 1, 10), (REC_CC, 1, 11), (REC_CC, 2, 20), (REC_NOTEON, 60, 100),
+            (REC_CC, 2, 21), (REC_PB, 0, 100), (REC_CC, 1, 12), (REC_PB, 0, 200),
+            (REC_CC, 64, 127), (REC_CC, 1, 13), (REC_CC, 2, 22), (REC_CC, 1, 14)]
+    for kind, a, b in recs:
+        ctl.seq.inject(make_event((0, kind, 0, 0, a, b)))
+    ctl.poll()
+    assert delivered == [("cc", 1, 11), ("cc", 2, 20), ("note", 60),
+                         ("cc", 2, 21), ("pb", 200), ("cc", 1, 12), ("cc", 64, 127),
+                         ("cc", 1, 14), ("cc", 2, 22)], delivered
+    assert ctl.cc_coalesced == 3, ctl.cc_coalesced
+
+CHECKS = {
+    "passes": check_passes,
+    "calibration": check_calibration,
+    "osc": check_osc,
+    "alloff": check_alloff,
+    "synths": check_synths,
+    "keymap": check_keymap,
+    "coalesce": check_coalesce,
+}
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Run self-checks")
+    parser.add_argument("checks", nargs="*", help="any of: " + ", ".join(CHECKS))
+    args = parser.parse_args(argv)
+    for name in args.checks:
+        if name not in CHECKS:
+            parser.error("unknown check %r" % name)
+    failed = 0
+    for name in args.checks or CHECKS.keys():
+        try:
+            CHECKS[name]()
+            print("ok    %s" % name)
+        except AssertionError as e:
+            print("FAIL  %s: %s" % (name, e))
+            failed += 1
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,166 @@
+# Fixed-size ring of recent samples. add() is cheap enough to call from the
+# render loop; percentiles are only computed when somebody polls summary().
+class RingStats(object):
+    def __init__(self, size=1024):
+        self.size = size
+        self.buf = [0.0] * size
+        self.pos = 0
+        self.count = 0
+
+    def add(self, v):
+        self.buf[self.pos] = v
+        self.pos += 1
+        if self.pos == self.size:
+            self.pos = 0
+        self.count += 1
+
+    def values(self):
+        if self.count < self.size:
+            return self.buf[:self.count]
+        return self.buf[:]
+
+    def summary(self):
+        vals = sorted(self.values())
+        n = len(vals)
+        if not n:
+            return None
+        def pct(p):
+            return vals[min(n - 1, int(p * n))]
+        return {
+            "n": n,
+            "mean": sum(vals) / n,
+            "p50": pct(0.50),
+            "p95": pct(0.95),
+            "p99": pct(0.99),
+            "max": vals[-1],
+        }
+
+# Fixed-bin histogram; out-of-range samples land in the first/last bin
+class Histogram(object):
+    def __init__(self, lo, hi, bins):
+        self.lo = lo
+        self.hi = hi
+        self.width = (hi - lo) / bins
+        self.counts = [0] * bins
+
+    def add(self, v):
+        i = int((v - self.lo) / self.width)
+        if i < 0:
+            i = 0
+        elif i >= len(self.counts):
+            i = len(self.counts) - 1
+        self.counts[i] += 1
+
+    def bins(self):
+        return [(self.lo + i * self.width, c) for i, c in enumerate(self.counts)]
+
+    def format(self, scale=1, unit=""):
+        total = sum(self.counts) or 1
+        peak = max(self.counts) or 1
+        lines = []
+        for lo, c in self.bins():
+            if c:
+                lines.append("%9.3f%s %7d %5.1f%% %s" % (lo * scale, unit, c, 100.0 * c / total,
+                                                       "#" * (40 * c // peak)))
+        return "\n".join(lines)
+
+# Input-to-light latency of stamped note events, split at the frame that
+# first draws the voice: queue (arrival to frame start), build (frame
+# start to display list done) and submit (renderFrame() call, which returns
+# once the frame is handed to the output). Seconds, from the render thread.
+class LatencyStats(object):
+    STAGES = ("queue", "build", "submit", "total")
+
+    def __init__(self, hi=0.05, bins=100, size=1024):
+        self.hist = {k: Histogram(0, hi, bins) for k in self.STAGES}
+        self.rings = {k: RingStats(size) for k in self.STAGES}
+
+    def add(self, stamp, start, built, done):
+        for k, v in zip(self.STAGES, (start - stamp, built - start, done - built, done - stamp)):
+            self.hist[k].add(v)
+            self.rings[k].add(v)
+
+    def summary(self):
+        return {k: r.summary() for k, r in self.rings.items()}
+
+    def format(self, hist="total"):
+        lines = []
+        for k in self.STAGES:
+            s = self.rings[k].summary()
+            if s is not None:
+                lines.append("latency %-6s n=%-5d p50=%7.2fms p95=%7.2fms p99=%7.2fms max=%7.2fms" % (
+                    k, s["n"], s["p50"] * 1000, s["p95"] * 1000, s["p99"] * 1000, s["max"] * 1000))
+        if hist and lines:
+            lines.append(self.hist[hist].format(1000, "ms"))
+        return "\n".join(lines)
+
+class RenderStats(object):
+    FRAME_KEYS = ("build", "render", "voices", "prims")
+    CHANNEL_KEYS = ("build", "voices", "prims")
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.frame = {k: RingStats(size) for k in self.FRAME_KEYS}
+        self.channels = {}
+        self.voice_types = {}
+        self.extra = {}
+
+    def _rings(self, table, key):
+        rings = table.get(key)
+        if rings is None:
+            rings = table[key] = {k: RingStats(self.size) for k in self.CHANNEL_KEYS}
+        return rings
+
+    def add_frame(self, build, render, voices, prims):
+        f = self.frame
+        f["build"].add(build)
+        f["render"].add(render)
+        f["voices"].add(voices)
+        f["prims"].add(prims)
+
+    # Optional per-frame metrics from frame passes (merge, reorder, ...)
+    def add(self, key, v):
+        ring = self.extra.get(key)
+        if ring is None:
+            ring = self.extra[key] = RingStats(self.size)
+        ring.add(v)
+
+    def add_channel(self, chid, voice_type, build, voices, prims):
+        for rings in (self._rings(self.channels, chid),
+                      self._rings(self.voice_types, voice_type)):
+            rings["build"].add(build)
+            rings["voices"].add(voices)
+            rings["prims"].add(prims)
+
+    def summary(self):
+        def summarize(rings):
+            return {k: r.summary() for k, r in rings.items()}
+        return {
+            "frame": summarize(self.frame),
+            "extra": summarize(self.extra),
+            "channels": {k: summarize(v) for k, v in list(self.channels.items())},
+            "voice_types": {k: summarize(v) for k, v in list(self.voice_types.items())},
+        }
+
+    def format(self, summary=None):
+        if summary is None:
+            summary = self.summary()
+        lines = []
+        def fmt(name, s, scale=1, unit=""):
+            if s is None:
+                return
+            lines.append("%-20s n=%-5d p50=%8.3f%s p95=%8.3f%s p99=%8.3f%s max=%8.3f%s" % (
+                name, s["n"], s["p50"] * scale, unit, s["p95"] * scale, unit,
+                s["p99"] * scale, unit, s["max"] * scale, unit))
+        f = summary["frame"]
+        fmt("frame build", f["build"], 1000, "ms")
+        fmt("frame render", f["render"], 1000, "ms")
+        fmt("frame voices", f["voices"])
+        fmt("frame prims", f["prims"])
+        for k in sorted(summary["extra"]):
+            fmt(k, summary["extra"][k])
+        for title, table in (("ch", summary["channels"]), ("voice", summary["voice_types"])):
+            for k in sorted(table):
+                fmt("%s %s build" % (title, k), table[k]["build"], 1000, "ms")
+                fmt("%s %s prims" % (title, k), table[k]["prims"])
+        return "\n".join(lines)
@@ -0,0 +1,261 @@
+import numpy as np
+
+from util import ctime
+from displaylist import PRIM_LINE, PRIM_DOT, colormul, grey
+from colors import fade_table
+from voices import (BasicSynth, BarVoice, BeamVoice, MultiBeamVoice, DropVoice,
+                    DEGRADE_ORDER, EV_NOTEON, EV_NOTEOFF, EV_ALLOFF, EV_PANIC)
+
+VT_BAR = 0
+VT_BEAM = 1
+VT_MULTI_BEAM = 2
+VT_DROP = 3
+
+VOICE_TYPES = {
+    BarVoice: VT_BAR,
+    BeamVoice: VT_BEAM,
+    MultiBeamVoice: VT_MULTI_BEAM,
+    DropVoice: VT_DROP,
+}
+
+MULTI_BEAM_X = (np.arange(10) + 0.5) / 10
+
+def colormul_array(a, b):
+    return ((((a >> 16) & 0xff) * ((b >> 16) & 0xff)) // 255) << 16 | \
+           ((((a >> 8) & 0xff) * ((b >> 8) & 0xff)) // 255) << 8 | \
+           ((a & 0xff) * (b & 0xff)) // 255
+
+# Struct-of-arrays voice table. Live voices occupy slots [0, n) sorted by
+# (l, r), like BasicSynth.keys, so they are drawn left to right; kt is NaN
+# while the voice is held, stamp is NaN once the voice has been drawn (or if
+# it has no input stamp).
+class VoicePool(object):
+    FIELDS = (("l", np.float64), ("r", np.float64), ("st", np.float64),
+              ("kt", np.float64), ("vel", np.int16), ("vtype", np.int8),
+              ("stamp", np.float64))
+
+    def __init__(self, capacity=64):
+        self.n = 0
+        self.capacity = capacity
+        for name, dtype in self.FIELDS:
+            setattr(self, name, np.zeros(capacity, dtype))
+
+    def grow(self):
+        self.capacity *= 2
+        for name, dtype in self.FIELDS:
+            old = getattr(self, name)
+            new = np.zeros(self.capacity, dtype)
+            new[:self.n] = old[:self.n]
+            setattr(self, name, new)
+
+    def find(self, l, r):
+        n = self.n
+        idx = np.flatnonzero((self.l[:n] == l) & (self.r[:n] == r))
+        return idx[0] if len(idx) else None
+
+    def add(self, l, r, st, kt, vel, vtype, stamp=np.nan):
+        i = self.find(l, r)
+        if i is not None:
+            self.remove(np.arange(self.n) == i)
+        if self.n == self.capacity:
+            self.grow()
+        n = self.n
+        pl, pr = self.l[:n], self.r[:n]
+        i = int(np.count_nonzero((pl < l) | ((pl == l) & (pr < r))))
+        if i < n:
+            for name, dtype in self.FIELDS:
+                a = getattr(self, name)
+                a[i + 1:n + 1] = a[i:n]
+        self.l[i] = l
+        self.r[i] = r
+        self.st[i] = st
+        self.kt[i] = kt
+        self.vel[i] = vel
+        self.vtype[i] = vtype
+        self.stamp[i] = stamp
+        self.n += 1
+
+    def off(self, t, i=None):
+        n = self.n
+        if i is None:
+            kt = self.kt[:n]
+            kt[~(kt <= t)] = t
+        elif not self.kt[i] <= t:
+            self.kt[i] = t
+
+    def remove(self, mask):
+        keep = np.flatnonzero(~mask)
+        m = len(keep)
+        for name, dtype in self.FIELDS:
+            a = getattr(self, name)
+            a[:m] = a[keep]
+        self.n = m
+
+    def clear(self):
+        self.n = 0
+
+# BasicSynth with its voices kept in a VoicePool. Envelopes, expiry, budget
+# fitting and geometry for all voices of the channel are computed in one
+# vectorized pass; the voice classes in voices.py remain the reference.
+class PooledSynth(BasicSynth):
+    def __init__(self, parent, voice, adsr):
+        super().__init__(parent, voice, adsr)
+        self.pool = VoicePool()
+
+    def noteon(self, l, r, vel, duration=None, at=None, stamp=None):
+        t = ctime() if at is None else at
+        self.post(t, EV_NOTEON, (l, r, vel, duration, VOICE_TYPES[self.voice],
+                                 np.nan if stamp is None else stamp))
+
+    def apply_events(self, now=None):
+        pool = self.pool
+        for t, ev, arg in self.due_events(now):
+            if ev == EV_NOTEON:
+                l, r, vel, duration, vtype, stamp = arg
+                kt = np.nan if duration is None else t + duration
+                pool.add(l, r, t, kt, vel, vtype, stamp)
+            elif ev == EV_NOTEOFF:
+                i = pool.find(*arg)
+                if i is not None:
+                    pool.off(t, i)
+            elif ev == EV_ALLOFF:
+                pool.off(t)
+            elif ev == EV_PANIC:
+                pool.clear()
+
+    def costs(self, mult):
+        pool = self.pool
+        n = pool.n
+        vtype = pool.vtype[:n]
+        cost = np.full(n, mult)
+        cost[vtype == VT_BEAM] = 1
+        mb = vtype == VT_MULTI_BEAM
+        if mb.any():
+            x = MULTI_BEAM_X
+            cost[mb] = ((pool.l[:n][mb, None] <= x) & (x <= pool.r[:n][mb, None])).sum(1)
+        return cost
+
+    def cost(self):
+        if not self.pool.n:
+            return 0
+        return int(self.costs(self.parent.state["voice"].get("mult", 1)).sum())
+
+    def fit(self, draw, t, mult, limit, order):
+        pool = self.pool
+        n = pool.n
+        costs = self.costs(mult)
+        cost = costs[draw].sum()
+        for step in order:
+            if cost <= limit:
+                break
+            if step == "mult":
+                while mult > 1 and cost > limit:
+                    c = self.costs(mult - 1)
+                    if c[draw].sum() >= cost:
+                        break
+                    mult -= 1
+                    costs = c
+                    cost = costs[draw].sum()
+            elif step == "release":
+                kt = pool.kt[:n]
+                rel = np.flatnonzero(draw & (kt <= t))
+                for i in rel[np.argsort(kt[rel], kind="stable")]:
+                    if cost <= limit:
+                        break
+                    draw[i] = False
+                    cost -= costs[i]
+            elif step == "merge":
+                reach = None
+                idx = np.flatnonzero(draw)
+                for i in idx[np.lexsort((-pool.r[idx], pool.l[idx]))]:
+                    if reach is not None and pool.r[i] <= reach:
+                        if cost <= limit:
+                            break
+                        draw[i] = False
+                        cost -= costs[i]
+                    else:
+                        reach = pool.r[i]
+        if cost > limit:
+            # Still over: hard cap, keeping the most recently started voices
+            idx = np.flatnonzero(draw)
+            idx = idx[np.argsort(-pool.st[idx], kind="stable")]
+            draw[:] = False
+            cost = 0
+            for i in idx:
+                if cost + costs[i] <= limit:
+                    draw[i] = True
+                    cost += costs[i]
+        return mult, draw
+
+    def render(self, dl, t, limit=None, order=DEGRADE_ORDER):
+        pool = self.pool
+        n = pool.n
+        if not n:
+            return 0
+        adsr = self.adsr
+        power = int(self.parent.state.get("fader", 127) / 127.0 * 255.0)
+        mult = self.parent.state["voice"].get("mult", 1)
+        l, r, st, vtype = pool.l[:n], pool.r[:n], pool.st[:n], pool.vtype[:n]
+        ct = t - st
+
+        # Envelope and expiry for every voice in one pass
+        v = adsr.evaluate_array(ct, pool.kt[:n] - st)
+        done = np.isnan(v)
+        v = v ** 2
+        drop = vtype == VT_DROP
+        if drop.any():
+            dv = max(0.1, adsr.a + adsr.d + adsr.r)
+            dvv = np.clip(1. - ct / dv, 0.0, 1.0)
+            done = np.where(drop, dvv <= 0, done)
+            v = np.where(drop, dvv, v)
+
+        draw = ~done
+        if limit is not None:
+            mult, draw = self.fit(draw, t, mult, limit, order)
+
+        base = colormul(dl.color, grey(power))
+        level = (255 * np.where(draw, v, 0)).astype(np.int64) * 0x010101
+        color = colormul_array(colormul(base, self.color), level)
+
+        prims = []
+        sel = draw & (vtype == VT_BAR)
+        if sel.any():
+            for x0, x1, c in zip(l[sel].tolist(), r[sel].tolist(), color[sel].tolist()):
+                prims.extend([(PRIM_LINE, x0, 0, x1, 0, c, 0)] * mult)
+
+        sel = draw & (vtype == VT_BEAM)
+        if sel.any():
+            x = ((l[sel] + r[sel]) / 2).tolist()
+            prims.extend((PRIM_DOT, px, 0, px, 0, c, mult)
+                         for px, c in zip(x, color[sel].tolist()))
+
+        sel = draw & (vtype == VT_MULTI_BEAM)
+        if sel.any():
+            x = MULTI_BEAM_X
+            hit = (l[sel, None] <= x) & (x <= r[sel, None])
+            vi, di = np.nonzero(hit)
+            prims.extend((PRIM_DOT, px, 0, px, 0, c, mult)
+                         for px, c in zip(x[di].tolist(), color[sel][vi].tolist()))
+
+        sel = draw & drop
+        if sel.any():
+            dvv = v[sel]
+            x = (l[sel] + r[sel]) / 2
+            w = np.abs(l[sel] - r[sel]) / 2
+            fv = 1 - dvv
+            w *= (fv * fv * (3 - 2 * fv) + fv) / 2
+            dvv = 1 - (dvv ** 3)
+            c = fade_table(self.color)[(255 * dvv).astype(np.int64)].astype(np.int64)
+            c = colormul_array(base, c)
+            for x0, x1, pc in zip((x - w).tolist(), (x + w).tolist(), c.tolist()):
+                prims.extend([(PRIM_LINE, x0, 0, x1, 0, pc, 0)] * mult)
+
+        dl.prims.extend(prims)
+        stamp = pool.stamp[:n]
+        hit = draw & ~np.isnan(stamp)
+        if hit.any():
+            self.stamps.extend(stamp[hit].tolist())
+            stamp[hit] = np.nan
+        if done.any():
+            pool.remove(done)
+        return n
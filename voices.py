@@ -1,58 +1,87 @@
+import heapq, bisect, itertools
+
 from collections import OrderedDict
 from util import *
+from displaylist import grey
+from colors import GREY, fade_table
+from events import EventQueue
+from evlog import log
 
-import pylase as ol
+# Order in which an over-budget synth sheds work: lower mult, skip voices in
+# their release phase (oldest key-off first), skip voices covered by another
+DEGRADE_ORDER = ("mult", "release", "merge")
 
 class BaseVoice(object):
-    def __init__(self, l, r, duration=None):
+    def __init__(self, l, r, duration=None, st=None):
         self.l = l
         self.r = r
-        self.st = ctime()
+        self.st = ctime() if st is None else st
         self.kt = None
+        # Input arrival time, until the voice is first drawn
+        self.stamp = None
         if duration is not None:
             self.kt = self.st + duration
 
-    def off(self):
-        if self.kt is None or self.kt > ctime():
-            self.kt = ctime()
+    def off(self, t=None):
+        if t is None:
+            t = ctime()
+        if self.kt is None or self.kt > t:
+            self.kt = t
+
+    def cost(self, mult):
+        return mult
+
+    def expired(self, t, adsr):
+        ct = t - self.st
+        return adsr.evaluate(ct, self.kt - self.st if self.kt is not None else None) is None
 
-    def render(self, adsr, color, mult):
-        ct = ctime() - self.st
+    def render(self, dl, t, adsr, color, mult):
+        ct = t - self.st
         v = adsr.evaluate(ct, self.kt - self.st if self.kt is not None else None)
         if v is None:
             return True
         v = v ** 2
-        ol.pushColor()
-        ol.multColor(color)
-        self._render(ct, v, adsr, mult)
-        ol.popColor()
+        dl.pushColor()
+        dl.multColor(color)
+        self._render(dl, ct, v, adsr, mult)
+        dl.popColor()
         return False
 
 class BarVoice(BaseVoice):
     NAME = "Bar"
-    def _render(self, dt, v, adsr, mult):
+    def _render(self, dl, dt, v, adsr, mult):
         for i in range(mult):
-            ol.line((self.l, 0), (self.r, 0), ol.C_GREY(int(255 * v)))
+            dl.line((self.l, 0), (self.r, 0), GREY[int(255 * v)])
 
 class BeamVoice(BaseVoice):
     NAME = "Beam"
-    def _render(self, dt, v, adsr, mult):
+    def cost(self, mult):
+        return 1
+
+    def _render(self, dl, dt, v, adsr, mult):
         x = (self.l + self.r) / 2
-        ol.dot((x, 0), mult, ol.C_GREY(int(255 * v)))
+        dl.dot((x, 0), mult, GREY[int(255 * v)])
 
 class MultiBeamVoice(BaseVoice):
     NAME = "MultiBeam"
-    def _render(self, dt, v, adsr, mult):
+    def cost(self, mult):
+        return sum(1 for i in range(10) if self.l <= (i + 0.5) / 10 <= self.r)
+
+    def _render(self, dl, dt, v, adsr, mult):
         x = (self.l + self.r) / 2
         for i in range(10):
             px = (i + 0.5) / 10
             if self.l <= px <= self.r:
-                ol.dot((px, 0), mult, ol.C_GREY(int(255 * v)))
+                dl.dot((px, 0), mult, GREY[int(255 * v)])
 
 class DropVoice(BaseVoice):
     NAME = "Drop"
-    def render(self, adsr, color, mult):
-        ct = ctime() - self.st
+    def expired(self, t, adsr):
+        dv = max(0.1, adsr.a + adsr.d + adsr.r)
+        return t - self.st >= dv
+
+    def render(self, dl, t, adsr, color, mult):
+        ct = t - self.st
         x = (self.l + self.r) / 2
         dv = max(0.1, adsr.a + adsr.d + adsr.r)
         w = abs(self.l - self.r) / 2
@@ -61,53 +90,173 @@ class DropVoice(BaseVoice):
             return True
         w *= (ss(1 - v) + (1 - v)) / 2
         v = 1 - (v ** 3)
-        r, g, b = torgb(color)
-        cmax = max(r, g, b)
-        
+        c = int(fade_table(color)[int(255 * v)])
+
         for i in range(mult):
-            ol.line((x-w, 0), (x+w, 0), rgb(r - cmax * v, g - cmax * v, b - cmax * v))
+            dl.line((x-w, 0), (x+w, 0), c)
         return False
 
+EV_NOTEON = 0
+EV_NOTEOFF = 1
+EV_ALLOFF = 2
+EV_PANIC = 3
+
+# Posting order across all threads, taken when an event is queued; the
+# queues merge events by timestamp, which is not the order they were posted
+POST_SEQ = itertools.count()
+
+# Note events may come from any thread (GUI/MIDI, BPM clock); they are queued
+# and applied by the render thread at frame start, which owns self.voices.
+# self.keys lists the voice keys in (l, r) order, kept sorted on insertion,
+# so voices are submitted left to right for RENDER_NOREORDER.
+# noteon(at=t) schedules a note ahead of time: the voice starts exactly at t
+# and the event waits in self.pending until the first frame at or after t.
+# noteon(stamp=t) tags the voice with its input arrival time; render() moves
+# it to self.stamps when the voice is first drawn, for latency accounting.
 class BasicSynth(object):
     def __init__(self, parent, voice, adsr):
         self.parent = parent
         self.adsr = adsr
         self.voice = voice
         self.voices = {}
+        self.keys = []
+        self.events = EventQueue()
+        self.pending = []
+        self.stamps = []
         self.color = 0xffffff
 
-    def noteon(self, l, r, vel, duration=None):
-        key = (l, r)
-        if (l, r) in self.voices:
-            del self.voices[(l, r)]
-        self.voices[(l, r)] = self.voice(l, r, duration)
+    def noteon(self, l, r, vel, duration=None, at=None, stamp=None):
+        voice = self.voice(l, r, duration, at)
+        voice.stamp = stamp
+        self.post(voice.st, EV_NOTEON, voice)
 
     def noteoff(self, l, r, vel):
-        print("NOFF", (l, r), self.voices)
-        if (l, r) in self.voices:
-            self.voices[(l, r)].off()
-    
+        log.debug("synth", "NOFF %r", (l, r))
+        self.post(ctime(), EV_NOTEOFF, (l, r))
+
     def alloff(self):
-        for k, v in self.voices.items():
-            v.off()
+        self.post(ctime(), EV_ALLOFF, None)
 
     def panic(self):
-        self.voices = {}
-    
-    def render(self):
+        self.post(ctime(), EV_PANIC, None)
+
+    def post(self, t, ev, arg):
+        self.events.put((t, next(POST_SEQ), ev, arg))
+
+    # Events due by frame time now, in timestamp order; later ones are kept.
+    # ALLOFF and PANIC also cancel notes that were scheduled ahead of them,
+    # but not notes posted after them, from any thread.
+    def due_events(self, now):
+        pending = self.pending
+        for e in self.events.drain():
+            heapq.heappush(pending, e)
+        events = []
+        while pending and (now is None or pending[0][0] <= now):
+            t, seq, ev, arg = heapq.heappop(pending)
+            events.append((t, ev, arg))
+            if ev in (EV_ALLOFF, EV_PANIC):
+                pending[:] = [p for p in pending if p[2] != EV_NOTEON or p[1] > seq]
+                heapq.heapify(pending)
+        return events
+
+    def apply_events(self, now=None):
+        voices = self.voices
+        for t, ev, arg in self.due_events(now):
+            if ev == EV_NOTEON:
+                key = (arg.l, arg.r)
+                if key not in voices:
+                    bisect.insort(self.keys, key)
+                voices[key] = arg
+            elif ev == EV_NOTEOFF:
+                if arg in voices:
+                    voices[arg].off(t)
+            elif ev == EV_ALLOFF:
+                for v in voices.values():
+                    v.off(t)
+            elif ev == EV_PANIC:
+                voices.clear()
+                del self.keys[:]
+
+    def cost(self):
+        mult = self.parent.state["voice"].get("mult", 1)
+        return sum(v.cost(mult) for v in self.voices.values())
+
+    def fit(self, items, t, mult, limit, order):
+        cost = sum(v.cost(mult) for k, v in items)
+        for step in order:
+            if cost <= limit:
+                break
+            if step == "mult":
+                while mult > 1 and cost > limit:
+                    c = sum(v.cost(mult - 1) for k, v in items)
+                    if c >= cost:
+                        break
+                    mult -= 1
+                    cost = c
+            elif step == "release":
+                released = sorted((i for i in items if i[1].kt is not None and i[1].kt <= t),
+                                  key=lambda i: i[1].kt)
+                skip = set()
+                for k, v in released:
+                    if cost <= limit:
+                        break
+                    skip.add(k)
+                    cost -= v.cost(mult)
+                items = [i for i in items if i[0] not in skip]
+            elif step == "merge":
+                skip = set()
+                reach = None
+                for k, v in sorted(items, key=lambda i: (i[1].l, -i[1].r)):
+                    if reach is not None and v.r <= reach:
+                        if cost <= limit:
+                            break
+                        skip.add(k)
+                        cost -= v.cost(mult)
+                    else:
+                        reach = v.r
+                items = [i for i in items if i[0] not in skip]
+        if cost > limit:
+            # Still over: hard cap, keeping the most recently started voices
+            keep = set()
+            cost = 0
+            for k, v in sorted(items, key=lambda i: i[1].st, reverse=True):
+                c = v.cost(mult)
+                if cost + c <= limit:
+                    keep.add(k)
+                    cost += c
+            items = [i for i in items if i[0] in keep]
+        return mult, items
+
+    def render(self, dl, t, limit=None, order=DEGRADE_ORDER):
         if not self.voices:
             return 0
         #print(self.voices.keys())
-        voices = 0
         power = int(self.parent.state.get("fader", 127) / 127.0 * 255.0)
         mult = self.parent.state["voice"].get("mult", 1)
-        ol.pushColor()
-        ol.multColor(ol.C_GREY(power))
-        for k, v in sorted(list(self.voices.items())):
-            voices += 1
-            if v.render(self.adsr, self.color, mult):
+        voices = len(self.voices)
+        drawn = [(k, self.voices[k]) for k in self.keys]
+        done = []
+        if limit is not None:
+            items = []
+            for k, v in drawn:
+                if v.expired(t, self.adsr):
+                    done.append(k)
+                else:
+                    items.append((k, v))
+            mult, drawn = self.fit(items, t, mult, limit, order)
+        dl.pushColor()
+        dl.multColor(grey(power))
+        for k, v in drawn:
+            if v.render(dl, t, self.adsr, self.color, mult):
+                done.append(k)
+            elif v.stamp is not None:
+                self.stamps.append(v.stamp)
+                v.stamp = None
+        dl.popColor()
+        if done:
+            for k in done:
                 del self.voices[k]
-        ol.popColor()
+            self.keys = [k for k in self.keys if k in self.voices]
         return voices
         
         